@@ -0,0 +1,60 @@
+"""
+Compare the per-tick config cost of `monitor_battle` between the compiled snapshot and the former jsonpath lookup.
+
+    python -m benchmarks.config_get -c ./config/dev.json
+"""
+import argparse
+import json
+import timeit
+
+import config
+
+TICK_KEYS = [
+    config.NINTENDO_AUTO_STOP,
+    config.NINTENDO_MONITOR_FREEZE_TIME,
+    config.NINTENDO_RETRIEVE_PREVIOUS,
+    config.NINTENDO_MONITOR_INTERVAL,
+]
+
+
+def snapshot_tick():
+    for key in TICK_KEYS:
+        config.get(key)
+
+
+def attribute_tick():
+    nintendo = config.snapshot().nintendo
+    nintendo.monitor_auto_stop_in_minutes
+    nintendo.monitor_freeze_time_in_seconds
+    nintendo.retrieve_previous_in_minutes
+    nintendo.monitor_interval_in_seconds
+
+
+def jsonpath_tick(data: dict):
+    import jsonpath_ng
+    for key in TICK_KEYS:
+        [match.value for match in jsonpath_ng.parse(key).find(data)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark config lookups per monitor tick')
+    parser.add_argument('-c', '--config', type=str, default='./config/dev.json', metavar='<config_path>')
+    parser.add_argument('-n', '--number', type=int, default=1000)
+    args = parser.parse_args()
+
+    config.load(args.config)
+    seconds = timeit.timeit(snapshot_tick, number=args.number)
+    print(f'snapshot: {seconds / args.number * 1e6:.2f}us per tick')
+    seconds = timeit.timeit(attribute_tick, number=args.number)
+    print(f'attributes: {seconds / args.number * 1e6:.2f}us per tick')
+    try:
+        with open(args.config, 'r') as f:
+            data = json.load(f)
+        seconds = timeit.timeit(lambda: jsonpath_tick(data), number=args.number)
+        print(f'jsonpath: {seconds / args.number * 1e6:.2f}us per tick')
+    except ImportError:
+        print('jsonpath: skipped, install jsonpath-ng to compare')
+
+
+if __name__ == '__main__':
+    main()
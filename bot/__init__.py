@@ -1,40 +1,89 @@
+import asyncio
 import logging
 import os.path
-import sys
 
 import telegram.ext
 import telegram.request._httpxrequest
-from telegram.ext import Defaults, ApplicationBuilder, PicklePersistence, PersistenceInput, AIORateLimiter
+from telegram import Update
+from telegram.ext import Defaults, ApplicationBuilder, PicklePersistence, PersistenceInput, AIORateLimiter, TypeHandler, ContextTypes, Application
 
 import config
-from bot import profiles, start, jobs, data, nintendo, schedules, admin
+from bot import profiles, start, jobs, data, nintendo, schedules, admin, webhook
+from bot.cluster import cluster, Role, ReadOnlyPicklePersistence, run_worker
+from bot.outbox import outbox
+from bot.overload import overload
 from bot.utils import BackoffRetryRequest
+from utils import startup, metrics
+from utils.lease import leases
+from utils.watchdog import watchdog
+
+logger = logging.getLogger('bot')
+
+first_update_received = False
+
+
+async def report_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global first_update_received
+    if not first_update_received:
+        first_update_received = True
+        startup.report_first_update()
+
+
+async def post_init(application: Application):
+    if config.get(config.WATCHDOG_ENABLED):
+        watchdog.start()
+    overload.start()
+    leases.start()
+    if config.get(config.METRICS_ENABLED):
+        listen, port = config.get(config.METRICS_LISTEN), config.get(config.METRICS_PORT)
+        await metrics.serve_metrics(listen, port)
+        logger.info(f'Serving metrics. listen = {listen}, port = {port}')
+
+
+async def post_stop(application: Application):
+    # post_shutdown runs after the bot's requests are closed, so flush the outbox here
+    await outbox.close()
+
+
+async def post_shutdown(application: Application):
+    # let another replica take over the singleton jobs right away
+    await leases.release_all()
 
 
 def run():
     defaults = Defaults(
         parse_mode=telegram.constants.ParseMode.HTML,
     )
-    persistence = PicklePersistence(
-        filepath=os.path.join('data', 'data'),
-        store_data=PersistenceInput(
-            user_data=True,
-            bot_data=True,
-            chat_data=False,
-            callback_data=False,
-        )
+    store_data = PersistenceInput(
+        user_data=True,
+        bot_data=True,
+        chat_data=False,
+        callback_data=False,
     )
+    if cluster.role == Role.Worker:
+        # workers only read the frontend's data, and publish their changes through the cluster store
+        persistence = ReadOnlyPicklePersistence(filepath=os.path.join('data', 'data'), store_data=store_data)
+    elif cluster.role == Role.Frontend:
+        # write often, so workers see started and stopped monitors soon
+        persistence = PicklePersistence(filepath=os.path.join('data', 'data'), store_data=store_data, update_interval=config.get(config.CLUSTER_SYNC_INTERVAL))
+    else:
+        persistence = PicklePersistence(filepath=os.path.join('data', 'data'), store_data=store_data)
     request = BackoffRetryRequest(connection_pool_size=256)
-    application = (
+    builder = (
         ApplicationBuilder()
         .token(config.get(config.BOT_TOKEN))
         .defaults(defaults)
         .persistence(persistence)
         .get_updates_request(request)
         .request(request)
-        .rate_limiter(AIORateLimiter(max_retries=sys.maxsize))
-        .build()
+        .rate_limiter(AIORateLimiter(max_retries=config.get(config.BOT_RATE_LIMIT_RETRIES)))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
     )
+    application = builder.build()
+    if startup.profiler.enabled:
+        application.add_handler(TypeHandler(Update, report_first_update), group=-1)
     application.add_handlers(start.handlers)
     application.add_handlers(nintendo.handlers)
 
@@ -48,4 +97,10 @@ def run():
 
     # disable job queue logging
     # logging.getLogger("apscheduler.scheduler").disabled = True
-    application.run_polling()
+    if cluster.role == Role.Worker:
+        # a worker registers the handlers too, but never fetches updates
+        asyncio.run(run_worker(application))
+    elif config.get(config.BOT_WEBHOOK_ENABLED):
+        asyncio.run(webhook.run_webhook(application))
+    else:
+        application.run_polling()
@@ -1,18 +1,30 @@
+import asyncio
+import datetime
+import html
 import logging
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
 
+import config
 from bot.nintendo import stage_schedule
+from bot.overload import overload
+from bot.pool import pool, service_profiles
 from bot.schedules import update_schedule_image
-from bot.utils import admin_filter, current_profile
+from bot.utils import admin_filter, with_deadline
 from locales import _
+from utils import profiling
+from utils.tracing import tracer, Span
+from utils.watchdog import watchdog
 
 logger = logging.getLogger('bot.admin')
 
 
 class AdminButtonCallback:
     Schedules = 'ADMIN_SCHEDULES'
+    SlowTicks = 'ADMIN_SLOW_TICKS'
+    LoopStalls = 'ADMIN_LOOP_STALLS'
     Exit = 'ADMIN_EXIT'
 
 
@@ -21,12 +33,19 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [
             InlineKeyboardButton(_('Force Update Schedules'), callback_data=AdminButtonCallback.Schedules),
         ],
+        [
+            InlineKeyboardButton(_('Slowest Monitor Ticks'), callback_data=AdminButtonCallback.SlowTicks),
+        ],
+        [
+            InlineKeyboardButton(_('Event Loop Stalls'), callback_data=AdminButtonCallback.LoopStalls),
+        ],
         [
             InlineKeyboardButton(_('« Go Back'), callback_data=AdminButtonCallback.Exit),
         ],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(text=_('Admin Options:'), reply_markup=reply_markup)
+    text = '\n'.join([_('Admin Options:'), _('Shed level: {level}').format(level=overload.level.name)])
+    await update.message.reply_text(text=text, reply_markup=reply_markup)
 
 
 async def admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -35,24 +54,122 @@ async def admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(text=_('Exited admin settings.'))
 
 
+@with_deadline(config.DEADLINE_JOB)
 async def admin_update_schedules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     await query.edit_message_text(text=_('Updating schedules...'))
-    profile = current_profile(context)
-    resp = await stage_schedule(profile)
+    resp, profile = await pool.run(service_profiles(context.application), stage_schedule)
     logger.info(f'Got schedules. schedules={resp}')
     await update_schedule_image(resp, profile, context, force=True)
     await query.edit_message_text(text=_('Schedules have been updated.'))
 
 
+SLOW_TICKS_LIMIT = 10
+
+
+def _message_slow_tick(root: Span, spans: list[Span]) -> str:
+    phases: dict[str, float] = {}
+    for span in spans:
+        if span.parent_id == root.span_id:
+            phases[span.name] = phases.get(span.name, 0) + span.duration
+    phase_text = ', '.join(f'{name} {duration:.2f}s' for name, duration in sorted(phases.items(), key=lambda x: x[1], reverse=True))
+    error_text = f' <b>{html.escape(root.error)}</b>' if root.error is not None else ''
+    return f'<code>{root.duration:.2f}s</code> user {root.attributes.get("user_id")} <code>{root.trace_id[:8]}</code>{error_text}\n{phase_text}'
+
+
+async def admin_slow_ticks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    traces = tracer.slowest(SLOW_TICKS_LIMIT, name='monitor_battle')
+    if len(traces) == 0:
+        await query.edit_message_text(text=_('No monitor ticks in the last hour.'))
+        return
+    text = '\n\n'.join([_('Slowest monitor ticks in the last hour:')] + [_message_slow_tick(root, spans) for root, spans in traces])
+    await query.edit_message_text(text=text)
+
+
+LOOP_STALLS_LIMIT = 5
+
+
+async def admin_loop_stalls(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    offenders = watchdog.top(LOOP_STALLS_LIMIT)
+    if len(offenders) == 0:
+        await query.edit_message_text(text=_('No event loop stalls so far.'))
+        return
+    texts = [_('Top event loop stalls:')]
+    for o in offenders:
+        texts.append(f'<code>{o.total:.2f}s</code> / {o.count}x, worst <code>{o.worst:.2f}s</code>\n<pre>{html.escape(o.stack)}</pre>')
+    text = '\n\n'.join(texts)
+    if len(text) > MessageLimit.MAX_TEXT_LENGTH:
+        text = '\n'.join([texts[0]] + [f'<code>{o.total:.2f}s</code> / {o.count}x {html.escape(o.location)}' for o in offenders])
+    await query.edit_message_text(text=text)
+
+
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+profiling_lock = asyncio.Lock()
+
+
+def _profile_seconds(context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        seconds = int(context.args[0]) if len(context.args) > 0 else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = PROFILE_DEFAULT_SECONDS
+    return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+
+async def _reply_profile(update: Update, report: str, collapsed: str, name: str):
+    limit = MessageLimit.MAX_TEXT_LENGTH - len('<pre></pre>')
+    text = html.escape(report)
+    if len(text) > limit:
+        text = text[:text.rfind('\n', 0, limit)]
+    await update.message.reply_text(text=f'<pre>{text}</pre>')
+    if collapsed != '':
+        filename = f'{name}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}.collapsed'
+        await update.message.reply_document(document=collapsed.encode('utf-8'), filename=filename)
+
+
+async def profile_cpu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if profiling_lock.locked():
+        await update.message.reply_text(text=_('A profiler is already running.'))
+        return
+    async with profiling_lock:
+        seconds = _profile_seconds(context)
+        await update.message.reply_text(text=_('Profiling CPU for {seconds} seconds...').format(seconds=seconds))
+        stacks = await profiling.sample_cpu(seconds)
+        logger.info(f'Profiled CPU. seconds = {seconds}, samples = {sum(stacks.values())}')
+        await _reply_profile(update, profiling.cpu_report(stacks), profiling.collapsed(stacks), 'cpu')
+
+
+async def profile_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if profiling_lock.locked():
+        await update.message.reply_text(text=_('A profiler is already running.'))
+        return
+    async with profiling_lock:
+        seconds = _profile_seconds(context)
+        await update.message.reply_text(text=_('Tracing memory allocations for {seconds} seconds...').format(seconds=seconds))
+        before, after = await profiling.snapshot_memory(seconds)
+        logger.info(f'Profiled memory. seconds = {seconds}')
+        await _reply_profile(update, profiling.memory_report(before, after), profiling.memory_collapsed(after), 'memory')
+
+
 def init_admin(application: Application):
     application.add_handlers(handlers)
 
 
 handlers = [
     CommandHandler('admin', admin_menu, filters=admin_filter),
+    # non-blocking, so updates keep being processed while the profiler watches them
+    CommandHandler('profile_cpu', profile_cpu, filters=admin_filter, block=False),
+    CommandHandler('profile_memory', profile_memory, filters=admin_filter, block=False),
     CallbackQueryHandler(admin_update_schedules, pattern=AdminButtonCallback.Schedules),
+    CallbackQueryHandler(admin_slow_ticks, pattern=AdminButtonCallback.SlowTicks),
+    CallbackQueryHandler(admin_loop_stalls, pattern=AdminButtonCallback.LoopStalls),
     CallbackQueryHandler(admin_exit, pattern=AdminButtonCallback.Exit),
 ]
@@ -0,0 +1,407 @@
+import asyncio
+import bisect
+import contextlib
+import copy
+import enum
+import logging
+import os
+import signal
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import pymmh3
+from telegram.ext import PicklePersistence, Application
+
+import config
+from bot.data import Profile, UserData
+from utils import metrics
+
+logger = logging.getLogger('bot.cluster')
+
+cluster_members = metrics.gauge('cluster_members', 'Live workers seen by this process.')
+cluster_owned_users = metrics.gauge('cluster_owned_users', 'Registered users owned by this process.')
+
+
+class Role(str, enum.Enum):
+    Standalone = 'standalone'
+    Frontend = 'frontend'
+    Worker = 'worker'
+
+
+class HashRing:
+    """consistent hashing with virtual nodes, so a joining or leaving node only moves the keys next to it."""
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 64):
+        self.replicas = replicas
+        self.nodes: set[str] = set()
+        self._hashes: list[int] = []
+        self._owners: list[str] = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return pymmh3.hash(key) & 0xffffffff
+
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            h = self._hash(f'{node}#{i}')
+            idx = bisect.bisect(self._hashes, h)
+            self._hashes.insert(idx, h)
+            self._owners.insert(idx, node)
+
+    def remove(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        kept = [(h, o) for h, o in zip(self._hashes, self._owners) if o != node]
+        self._hashes = [h for h, _ in kept]
+        self._owners = [o for _, o in kept]
+
+    def owner(self, key: str) -> Optional[str]:
+        if len(self._hashes) == 0:
+            return None
+        idx = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[idx]
+
+
+@dataclass
+class MonitorStop:
+    id: int
+    name: str
+    chat_id: int
+    user_id: int
+
+
+@dataclass
+class ProfileState:
+    session_token: str
+    gtoken: str
+    bullet_token: str
+    account_name: str
+    country: str
+    failures: int
+    quarantined_until: float
+    quarantine_notified: bool
+
+    @staticmethod
+    def of(profile: Profile) -> 'ProfileState':
+        return ProfileState(
+            session_token=profile.session_token,
+            gtoken=profile.gtoken,
+            bullet_token=profile.bullet_token,
+            account_name=profile.account_name,
+            country=profile.country,
+            failures=profile.failures,
+            quarantined_until=profile.quarantined_until,
+            quarantine_notified=profile.quarantine_notified,
+        )
+
+    def apply(self, profile: Profile):
+        profile.gtoken = self.gtoken
+        profile.bullet_token = self.bullet_token
+        profile.account_name = self.account_name
+        profile.country = self.country
+        profile.failures = self.failures
+        profile.quarantined_until = self.quarantined_until
+        profile.quarantine_notified = self.quarantine_notified
+
+
+@dataclass
+class Progress:
+    user_id: int
+    last_battle: Optional[str]
+    last_coop: Optional[str]
+
+
+class ClusterStore:
+    """
+    The state shared by the processes of a cluster, in a sqlite file next to the pickle persistence.
+    - members: heartbeats of the workers.
+    - monitor_stops: monitors stopped by workers, for the frontend to remove from the persisted monitor jobs.
+    - profiles and progress: refreshed tokens and quarantine state per profile, and the last seen battle and coop
+      per user, so whichever process handles a user next picks up where the last one stopped.
+      rows carry an increasing `seq`, to read the changes since the last sync.
+    Blocking, so call it in an executor. Each call opens its own connection, so it is safe from any thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS members (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS monitor_stops (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS profiles (
+                    session_token TEXT PRIMARY KEY, gtoken TEXT, bullet_token TEXT, account_name TEXT, country TEXT,
+                    failures INTEGER, quarantined_until REAL, quarantine_notified INTEGER, seq INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS progress (
+                    user_id INTEGER PRIMARY KEY, last_battle TEXT, last_coop TEXT, seq INTEGER NOT NULL
+                );
+            ''')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def heartbeat(self, worker_id: str):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO members (worker_id, heartbeat) VALUES (?, ?)', (worker_id, time.time()))
+
+    def leave(self, worker_id: str):
+        with self._connect() as db:
+            db.execute('DELETE FROM members WHERE worker_id = ?', (worker_id,))
+
+    def members(self, ttl: float) -> list[str]:
+        with self._connect() as db:
+            rows = db.execute('SELECT worker_id FROM members WHERE heartbeat > ?', (time.time() - ttl,)).fetchall()
+        return [r[0] for r in rows]
+
+    def report_stop(self, name: str, chat_id: int, user_id: int):
+        with self._connect() as db:
+            db.execute('INSERT INTO monitor_stops (name, chat_id, user_id) VALUES (?, ?, ?)', (name, chat_id, user_id))
+
+    def stops(self) -> list[MonitorStop]:
+        with self._connect() as db:
+            rows = db.execute('SELECT id, name, chat_id, user_id FROM monitor_stops ORDER BY id').fetchall()
+        return [MonitorStop(*r) for r in rows]
+
+    def clear_stops(self, ids: list[int]):
+        with self._connect() as db:
+            db.executemany('DELETE FROM monitor_stops WHERE id = ?', [(i,) for i in ids])
+
+    def publish_profile(self, state: ProfileState):
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO profiles '
+                '(session_token, gtoken, bullet_token, account_name, country, failures, quarantined_until, quarantine_notified, seq) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM profiles))',
+                (state.session_token, state.gtoken, state.bullet_token, state.account_name, state.country,
+                 state.failures, state.quarantined_until, state.quarantine_notified),
+            )
+
+    def profiles_since(self, seq: int) -> tuple[list[ProfileState], int]:
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT session_token, gtoken, bullet_token, account_name, country, failures, quarantined_until, quarantine_notified, seq '
+                'FROM profiles WHERE seq > ? ORDER BY seq', (seq,)
+            ).fetchall()
+        return [ProfileState(*r[:7], bool(r[7])) for r in rows], max([r[8] for r in rows], default=seq)
+
+    def publish_progress(self, progress: Progress):
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO progress (user_id, last_battle, last_coop, seq) '
+                'VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM progress))',
+                (progress.user_id, progress.last_battle, progress.last_coop),
+            )
+
+    def progress_since(self, seq: int) -> tuple[list[Progress], int]:
+        with self._connect() as db:
+            rows = db.execute('SELECT user_id, last_battle, last_coop, seq FROM progress WHERE seq > ? ORDER BY seq', (seq,)).fetchall()
+        return [Progress(*r[:3]) for r in rows], max([r[3] for r in rows], default=seq)
+
+
+class ReadOnlyPicklePersistence(PicklePersistence):
+    """the frontend's pickle, read by workers. nothing is ever written, and `reload` reads the file again."""
+
+    async def reload(self) -> tuple[dict, dict]:
+        self.user_data = None
+        self.bot_data = None
+        return await self.get_user_data(), await self.get_bot_data()
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def flush(self):
+        pass
+
+
+class Cluster:
+    """
+    Splits background work over processes. Telegram updates are only handled by the frontend, while monitors,
+    keep-alive and so token refresh of each registered user are run by the worker owning the user on the hash ring.
+    The frontend owns every user while no worker is alive, so a cluster degrades to a standalone bot.
+    A standalone bot owns everything and has no store.
+    """
+
+    def __init__(self, role: Role, worker_id: Optional[str], path: str, replicas: int, ttl: float):
+        self.role = role
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.ring = HashRing(replicas=replicas)
+        self.store = ClusterStore(path) if role != Role.Standalone else None
+        self._profiles_seq = 0
+        self._progress_seq = 0
+        self._persistence_mtime = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.role != Role.Standalone
+
+    def owns(self, user_id: int) -> bool:
+        owner = self.ring.owner(str(user_id))
+        if self.role == Role.Worker:
+            return owner == self.worker_id
+        # standalone, or a frontend without workers
+        return owner is None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def sync_members(self):
+        """heartbeat as a worker, and rebuild the ring from the live workers."""
+        if self.role == Role.Worker:
+            await self._run(self.store.heartbeat, self.worker_id)
+        members = set(await self._run(self.store.members, self.ttl))
+        if members == self.ring.nodes:
+            return
+        logger.info(f'Cluster members changed. joined = {members - self.ring.nodes}, left = {self.ring.nodes - members}')
+        for node in self.ring.nodes - members:
+            self.ring.remove(node)
+        for node in members - self.ring.nodes:
+            self.ring.add(node)
+        cluster_members.set(len(members))
+
+    async def leave(self):
+        if self.role == Role.Worker:
+            await self._run(self.store.leave, self.worker_id)
+            logger.info(f'Left the cluster. worker_id = {self.worker_id}')
+
+    async def publish_profile(self, profile: Profile):
+        if self.enabled:
+            await self._run(self.store.publish_profile, ProfileState.of(profile))
+
+    async def publish_progress(self, user_id: int, user_data: dict):
+        if self.enabled:
+            await self._run(self.store.publish_progress, Progress(user_id, user_data.get(UserData.LastBattle), user_data.get(UserData.LastCoop)))
+
+    async def reload_persistence(self, application: Application):
+        """as a worker, load the frontend's pickle again if it changed since the last load."""
+        persistence: ReadOnlyPicklePersistence = application.persistence
+        try:
+            mtime = os.stat(persistence.filepath).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._persistence_mtime:
+            return
+        try:
+            user_data, bot_data = await persistence.reload()
+        except TypeError as e:
+            # caught the frontend writing it, try again on the next sync
+            logger.warning(f'Failed to reload persistence. error = {e}')
+            return
+        for user_id, data in (user_data or {}).items():
+            application.user_data[user_id].clear()
+            application.user_data[user_id].update(data)
+        application.bot_data.clear()
+        application.bot_data.update(bot_data)
+        self._persistence_mtime = mtime
+        # the pickle lags behind the store, so apply every shared change on top of it again
+        self._profiles_seq = 0
+        self._progress_seq = 0
+        logger.debug(f'Reloaded persistence. users = {len(user_data or {})}')
+
+    async def apply_updates(self, application: Application):
+        """apply the profile states and monitor progress published by the other processes since the last sync."""
+        states, self._profiles_seq = await self._run(self.store.profiles_since, self._profiles_seq)
+        progresses, self._progress_seq = await self._run(self.store.progress_since, self._progress_seq)
+        if len(states) == 0 and len(progresses) == 0:
+            return
+        changed = set()
+        by_token = {state.session_token: state for state in states}
+        for user_id, data in application.user_data.items():
+            for profile in data.get(UserData.Profiles, {}).values():
+                state = by_token.get(profile.session_token)
+                if state is not None and state != ProfileState.of(profile):
+                    state.apply(profile)
+                    changed.add(user_id)
+        for progress in progresses:
+            if progress.user_id not in application.user_data:
+                continue
+            data = application.user_data[progress.user_id]
+            if (data.get(UserData.LastBattle), data.get(UserData.LastCoop)) != (progress.last_battle, progress.last_coop):
+                data[UserData.LastBattle] = progress.last_battle
+                data[UserData.LastCoop] = progress.last_coop
+                changed.add(progress.user_id)
+        if self.role == Role.Frontend:
+            # jobs without a user do not mark user data for persistence, so write the changes now
+            for user_id in changed:
+                await application.persistence.update_user_data(user_id, copy.deepcopy(application.user_data[user_id]))
+
+    async def monitor_stops(self) -> list[MonitorStop]:
+        return await self._run(self.store.stops)
+
+    async def clear_monitor_stops(self, stops: list[MonitorStop]):
+        await self._run(self.store.clear_stops, [stop.id for stop in stops])
+
+    async def report_monitor_stop(self, name: str, chat_id: int, user_id: int):
+        await self._run(self.store.report_stop, name, chat_id, user_id)
+
+
+async def run_worker(application: Application):
+    """run the jobs of a worker until SIGINT/SIGTERM. updates are never fetched, they belong to the frontend."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # windows, rely on KeyboardInterrupt
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        await application.start()
+        logger.info(f'Running worker. worker_id = {cluster.worker_id}')
+        try:
+            await stop.wait()
+        finally:
+            await application.stop()
+            if application.post_stop is not None:
+                await application.post_stop(application)
+            # hand the users over now, instead of after the member ttl
+            await cluster.leave()
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
+
+
+cluster = Cluster(
+    role=Role(config.get(config.CLUSTER_ROLE) or Role.Standalone),
+    worker_id=config.get(config.CLUSTER_WORKER_ID) or None,
+    path=config.get(config.CLUSTER_PATH),
+    replicas=config.get(config.CLUSTER_VIRTUAL_NODES),
+    ttl=config.get(config.CLUSTER_MEMBER_TTL),
+)
@@ -1,13 +1,14 @@
 import datetime
 import logging
+import time
 from dataclasses import dataclass
 from typing import Union, Optional
 
 import pytz
 from telegram.ext import ContextTypes, Application
 
-import config
 from locales import _
+from nintendo.versions import registry
 
 logger = logging.getLogger('bot.data')
 
@@ -22,6 +23,7 @@ class BotData:
     StageImageIDs = 'STAGE_IMAGE_IDS'
     BattleImageIDs = 'BATTLE_IMAGE_IDS'
     CoopImageIDs = 'COOP_IMAGE_IDS'
+    Schedules = 'SCHEDULES'
 
     MonitorJobs = 'MONITOR_JOBS'
 
@@ -36,6 +38,7 @@ class UserData:
     MessageID_Timezone = 'MSG_ID_TZ'
     LastBattle = 'LAST_BATTLE'
     LastCoop = 'LAST_COOP'
+    PrivateChat = 'PRIVATE_CHAT'
 
 
 @dataclass
@@ -49,6 +52,14 @@ class Profile:
     country: str = ''
     language: str = ''
     timezone: str = ''
+    # login health, see bot.nintendo.auto_update_profile
+    failures: int = 0
+    quarantined_until: float = 0
+    quarantine_notified: bool = False
+
+    @property
+    def quarantined(self) -> bool:
+        return self.quarantined_until > time.time()
 
 
 @dataclass
@@ -521,14 +532,15 @@ class CommonParser:
 
 async def _init_bot_data(context: ContextTypes.DEFAULT_TYPE):
     logger.info('Initialized bot data')
-    context.bot_data.setdefault(BotData.NintendoAppVersion, config.get(config.NINTENDO_APP_VERSION))
-    context.bot_data.setdefault(BotData.S3SVersion, config.get(config.NINTENDO_S3S_VERSION))
-    context.bot_data.setdefault(BotData.WebviewVersion, config.get(config.NINTENDO_WEBVIEW_VERSION))
-    context.bot_data.setdefault(BotData.GraphQLRequestMap, config.get(config.NINTENDO_GRAPHQL_REQUEST_MAP))
+    context.bot_data[BotData.NintendoAppVersion] = registry.nsoapp_version
+    context.bot_data[BotData.S3SVersion] = registry.s3s_version
+    context.bot_data[BotData.WebviewVersion] = registry.webview_version
+    context.bot_data[BotData.GraphQLRequestMap] = registry.graphql_query_map
     context.bot_data.setdefault(BotData.RegisteredUsers, set())
     context.bot_data.setdefault(BotData.StageImageIDs, dict())
     context.bot_data.setdefault(BotData.BattleImageIDs, dict())
     context.bot_data.setdefault(BotData.CoopImageIDs, dict())
+    context.bot_data.setdefault(BotData.Schedules, None)
     context.bot_data.setdefault(BotData.MonitorJobs, set())
 
 
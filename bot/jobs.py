@@ -1,28 +1,76 @@
 import asyncio
+import copy
 import datetime
+import functools
 import logging
+import re
+import time
+import zlib
 from dataclasses import dataclass
+from typing import Optional
 
 import pytz
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
 from telegram import Update
-from telegram.ext import ContextTypes, Application, CommandHandler
+from telegram.ext import ContextTypes, Application, CommandHandler, JobQueue
 
 import config
 import nintendo.login
 import nintendo.query
+from nintendo.proxy import proxy_pool
+from nintendo.versions import registry
 from bot.battles import _message_battle_detail, BattleParser
+from bot.cluster import cluster, cluster_owned_users, Role
 from bot.coops import CoopParser, _message_coop_detail
-from bot.data import BotData, UserData
-from bot.nintendo import home, stage_schedule, battles, battle_detail, coops, coop_detail
+from bot.data import BotData, UserData, Profile
+from bot.nintendo import home, stage_schedule, battles, battle_detail, coops, coop_detail, last_success
+from bot.outbox import outbox
+from bot.overload import overload, ShedLevel
+from bot.pool import pool, service_profiles
 from bot.schedules import update_schedule_image
 from bot.utils import current_profile, translator
+from utils import metrics, deadline
+from utils.lease import leases
+from utils.tracing import tracer
 
 logger = logging.getLogger('bot.job')
 
+job_seconds = metrics.histogram('job_seconds', 'Duration of job runs.', ('job',))
+job_runs = metrics.counter('job_runs_total', 'Job runs by result.', ('job', 'result'))
+job_lag_seconds = metrics.histogram('job_lag_seconds', 'Delay between the scheduled and the actual start of job runs.', ('job',))
+keep_alive_runs = metrics.counter('keep_alive_total', 'Profiles handled by keep-alive by result.', ('result',))
+
+
+def instrument_job(fn):
+    @functools.wraps(fn)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        start = time.perf_counter()
+        try:
+            result = await fn(context)
+        except Exception:
+            job_runs.inc(job=fn.__name__, result='error')
+            raise
+        finally:
+            job_seconds.observe(time.perf_counter() - start, job=fn.__name__)
+        job_runs.inc(job=fn.__name__, result='success')
+        return result
+
+    return wrapper
+
+
+def _job_submitted(application: Application, event: JobSubmissionEvent):
+    job = application.job_queue.scheduler.get_job(event.job_id)
+    # per-user jobs are named like monitor_<user_id>
+    name = re.sub(r'_\d+$', '', job.name) if job is not None else 'unknown'
+    now = datetime.datetime.now().astimezone(pytz.UTC)
+    for run_time in event.scheduled_run_times:
+        job_lag_seconds.observe(max((now - run_time).total_seconds(), 0), job=name)
+
 
 @dataclass
 class MonitorJobData:
     last_update_time: datetime.datetime
+    last_tick: float = 0
 
 
 @dataclass
@@ -55,7 +103,21 @@ def monitor_job_kwargs(job_name):
            }
 
 
+@instrument_job
 async def monitor_battle(context: ContextTypes.DEFAULT_TYPE):
+    job_data: MonitorJobData = context.job.data
+    if overload.should_skip_tick('monitor_battle', job_data.last_tick, config.get(config.NINTENDO_MONITOR_INTERVAL)):
+        return
+    job_data.last_tick = time.monotonic()
+    profile = current_profile(context, user_id=context.job.user_id)
+    if profile is not None and profile.quarantined:
+        await notify_quarantined(context, context.job.chat_id, profile)
+        return
+    with tracer.span('monitor_battle', user_id=context.job.user_id), deadline.scope(config.get(config.DEADLINE_MONITOR)):
+        await _monitor_battle(context)
+
+
+async def _monitor_battle(context: ContextTypes.DEFAULT_TYPE):
     profile = current_profile(context, user_id=context.job.user_id)
     _ = translator(profile)
     job_data: MonitorJobData = context.job.data
@@ -65,9 +127,12 @@ async def monitor_battle(context: ContextTypes.DEFAULT_TYPE):
 
     if job_data.last_update_time > datetime.datetime.now().astimezone(pytz.UTC) - freeze_time:
         return
+    progress = (context.user_data[UserData.LastBattle], context.user_data[UserData.LastCoop])
 
-    resp = await battles(profile)
-    battle_histories = BattleParser.battle_histories(resp)
+    with tracer.span('history'):
+        resp = await battles(profile)
+    with tracer.span('parse'):
+        battle_histories = BattleParser.battle_histories(resp)
     battle_ids = [b.id for b in battle_histories]
     last_battle_id = context.user_data[UserData.LastBattle]
     if len(battle_ids) > 0:
@@ -78,17 +143,22 @@ async def monitor_battle(context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             cnt = len(battle_ids)
         for battle_id in battle_ids[:cnt][::-1]:
-            resp = await battle_detail(profile, battle_id)
-            detail = BattleParser.battle_detail(resp)
+            with tracer.span('detail'):
+                resp = await battle_detail(profile, battle_id)
+            with tracer.span('parse'):
+                detail = BattleParser.battle_detail(resp)
             if detail.start_time < datetime.datetime.now().astimezone(pytz.UTC) - retrieve_previous_delta:
                 continue
-            text = _message_battle_detail(_, detail, profile)
-            await context.bot.send_message(chat_id=context.job.chat_id, text=text)
+            with tracer.span('render'):
+                text = _message_battle_detail(_, detail, profile)
+            outbox.send(context.bot, context.job.chat_id, text)
             job_data.last_update_time = datetime.datetime.now().astimezone(pytz.UTC)
         context.user_data[UserData.LastBattle] = battle_ids[0]
 
-    resp = await coops(profile)
-    coop_histories = CoopParser.coop_histories(resp)
+    with tracer.span('history'):
+        resp = await coops(profile)
+    with tracer.span('parse'):
+        coop_histories = CoopParser.coop_histories(resp)
     coop_ids = [c.id for c in coop_histories]
     if len(coop_ids) > 0:
         last_coop_id = context.user_data[UserData.LastCoop]
@@ -99,18 +169,23 @@ async def monitor_battle(context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             cnt = len(coop_ids)
         for coop_id in coop_ids[:cnt][::-1]:
-            resp = await coop_detail(profile, coop_id)
-            detail = CoopParser.coop_detail(resp)
+            with tracer.span('detail'):
+                resp = await coop_detail(profile, coop_id)
+            with tracer.span('parse'):
+                detail = CoopParser.coop_detail(resp)
             if detail.start_time < datetime.datetime.now().astimezone(pytz.UTC) - retrieve_previous_delta:
                 continue
-            text = _message_coop_detail(_, detail, profile)
-            await context.bot.send_message(chat_id=context.job.chat_id, text=text)
+            with tracer.span('render'):
+                text = _message_coop_detail(_, detail, profile)
+            outbox.send(context.bot, context.job.chat_id, text)
             job_data.last_update_time = datetime.datetime.now().astimezone(pytz.UTC)
         context.user_data[UserData.LastCoop] = coop_ids[0]
+    if progress != (context.user_data[UserData.LastBattle], context.user_data[UserData.LastCoop]):
+        await cluster.publish_progress(context.job.user_id, context.user_data)
 
     if job_data.last_update_time < datetime.datetime.now().astimezone(pytz.UTC) - auto_stop_delta:
         text = ' '.join([_('No updates for a while.'), _('Stop monitoring the updates.')])
-        await context.bot.send_message(chat_id=context.job.chat_id, text=text)
+        outbox.send(context.bot, context.job.chat_id, text)
         job_param = JobParameters(
             name=context.job.name,
             chat_id=context.job.chat_id,
@@ -121,6 +196,9 @@ async def monitor_battle(context: ContextTypes.DEFAULT_TYPE):
             monitor_jobs.remove(job_param)
         except KeyError:
             pass
+        if cluster.role == Role.Worker:
+            # the monitor jobs are persisted by the frontend
+            await cluster.report_monitor_stop(job_param.name, job_param.chat_id, job_param.user_id)
         context.job.schedule_removal()
 
 
@@ -135,6 +213,7 @@ async def monitor_battle_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id=update.message.from_user.id,
     )
     if job_param in monitor_jobs:
+        # in a cluster, the worker running it stops it once it sees the removal
         await update.message.reply_text(text=_('Stop monitoring the updates.'))
         jobs = context.job_queue.get_jobs_by_name(job_name)
         for job in jobs:
@@ -142,115 +221,296 @@ async def monitor_battle_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
         monitor_jobs.remove(job_param)
     else:
         await update.message.reply_text(text=_('Start monitoring the updates.'))
-        context.job_queue.run_custom(
-            monitor_battle,
-            job_kwargs=monitor_job_kwargs(job_param.name),
-            data=MonitorJobData(
-                last_update_time=datetime.datetime.now().astimezone(pytz.UTC),
-            ),
-            name=job_param.name,
-            chat_id=job_param.chat_id,
-            user_id=job_param.user_id,
-        )
         monitor_jobs.add(job_param)
+        if cluster.owns(job_param.user_id):
+            start_monitor(context.job_queue, job_param)
+
+
+def start_monitor(job_queue: JobQueue, job_param: JobParameters):
+    job_queue.run_custom(
+        monitor_battle,
+        job_kwargs=monitor_job_kwargs(job_param.name),
+        data=MonitorJobData(
+            last_update_time=datetime.datetime.now().astimezone(pytz.UTC),
+        ),
+        name=job_param.name,
+        chat_id=job_param.chat_id,
+        user_id=job_param.user_id,
+    )
 
 
+def _retry_skipped_run(context: ContextTypes.DEFAULT_TYPE, job):
+    """
+    run a periodic singleton job skipped by this replica once more after the lease ttl, so the run is not lost to
+    a holder that is gone, e.g. a crashed replica. the retry is not retried again, the next period tries anyway.
+    """
+    name = f'{job.__name__}_retry'
+    if context.job.name != name:
+        context.job_queue.run_once(job, when=leases.ttl, name=name)
+
+
+async def _retry_recover_monitor_jobs(context: ContextTypes.DEFAULT_TYPE):
+    # another replica runs the monitors. try again later, to take them over if it goes away
+    context.job_queue.run_once(recover_monitor_jobs, when=leases.ttl)
+
+
+async def _stop_recovered_monitor_jobs(context: ContextTypes.DEFAULT_TYPE):
+    # another replica may have recovered the monitors by now, so stop ours to not notify twice
+    for job in context.job_queue.jobs():
+        if job.callback is monitor_battle and not job.removed:
+            job.schedule_removal()
+    logger.warning('Stopped monitors after losing the recovery lease.')
+    await _retry_recover_monitor_jobs(context)
+
+
+@instrument_job
+@leases.singleton(follower=_retry_recover_monitor_jobs, on_lost=_stop_recovered_monitor_jobs)
 async def recover_monitor_jobs(context: ContextTypes.DEFAULT_TYPE):
     jobs: set[JobParameters] = context.bot_data[BotData.MonitorJobs]
     for job_param in jobs:
-        context.job_queue.run_custom(
-            monitor_battle,
-            job_kwargs=monitor_job_kwargs(job_param.name),
-            data=MonitorJobData(
-                last_update_time=datetime.datetime.now().astimezone(pytz.UTC),
-            ),
-            name=job_param.name,
-            chat_id=job_param.chat_id,
-            user_id=job_param.user_id,
-        )
+        start_monitor(context.job_queue, job_param)
+
+
+@instrument_job
+async def cluster_sync_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    sync with the other processes of the cluster, then run the monitors of exactly the owned users.
+    a frontend removes the monitors stopped by workers from the persisted ones, a worker reloads the persisted data.
+    """
+    await cluster.sync_members()
+    stops = await cluster.monitor_stops()
+    if cluster.role == Role.Worker:
+        # stops are read before the reload, so a reported stop is skipped until the reloaded data has it removed
+        await cluster.reload_persistence(context.application)
+        if registry.changed():
+            registry.load()
+    elif len(stops) > 0:
+        monitor_jobs: set[JobParameters] = context.bot_data[BotData.MonitorJobs]
+        for stop in stops:
+            monitor_jobs.discard(JobParameters(name=stop.name, chat_id=stop.chat_id, user_id=stop.user_id))
+        await context.application.persistence.update_bot_data(copy.deepcopy(context.bot_data))
+        await cluster.clear_monitor_stops(stops)
+        stops = []
+    await cluster.apply_updates(context.application)
+
+    stopped = {stop.name for stop in stops}
+    wanted = {p.name: p for p in context.bot_data.get(BotData.MonitorJobs, set()) if cluster.owns(p.user_id) and p.name not in stopped}
+    running = {job.name: job for job in context.job_queue.jobs() if job.callback is monitor_battle and not job.removed}
+    for name, job in running.items():
+        if name not in wanted:
+            logger.info(f'Handing over monitor. job = {name}')
+            job.schedule_removal()
+    for name, job_param in wanted.items():
+        if name not in running:
+            logger.info(f'Taking over monitor. job = {name}')
+            start_monitor(context.job_queue, job_param)
+    cluster_owned_users.set(sum(cluster.owns(user) for user in context.bot_data.get(BotData.RegisteredUsers, set())))
+
+
+def _sync_versions(context: ContextTypes.DEFAULT_TYPE):
+    context.bot_data[BotData.NintendoAppVersion] = registry.nsoapp_version
+    context.bot_data[BotData.S3SVersion] = registry.s3s_version
+    context.bot_data[BotData.WebviewVersion] = registry.webview_version
+    context.bot_data[BotData.GraphQLRequestMap] = registry.graphql_query_map
 
 
+async def _reload_versions(context: ContextTypes.DEFAULT_TYPE):
+    # the leader saves the registry, so followers read it instead of scraping the sources again
+    if registry.changed():
+        registry.load()
+        _sync_versions(context)
+    _retry_skipped_run(context, update_nso_version_job)
+
+
+@instrument_job
+@leases.singleton(follower=_reload_versions)
 async def update_nso_version_job(context: ContextTypes.DEFAULT_TYPE):
-    version = await nintendo.login.update_nsoapp_version()
-    logger.info(f'Updated Nintendo Online App version. version = {version}')
+    sources = {
+        'app version': nintendo.login.update_nsoapp_version(),
+        'webview version': nintendo.login.update_webview_version(),
+        'GraphQL request map': nintendo.query.update_graphql_query_map(),
+        's3s version': nintendo.login.update_s3s_version(),
+    }
+    results = await asyncio.gather(*sources.values(), return_exceptions=True)
+    for source, result in zip(sources.keys(), results):
+        if isinstance(result, Exception):
+            logger.error(f'Failed to update {source}, keeping the known one. error = {result}')
+        else:
+            logger.info(f'Updated {source}. value = {result}')
+    await leases.check()
+    # a source answering 304 is checked too, but if any failed, the next boot should try again at once
+    registry.save(refreshed=all(not isinstance(result, Exception) for result in results))
+    _sync_versions(context)
+
+
+@instrument_job
+async def check_proxies_job(context: ContextTypes.DEFAULT_TYPE):
+    # drop the pins of profiles that are gone, before the check rebalances by load
+    profiles = [user_data.get(UserData.Profiles, {}).values() for user_data in context.application.user_data.values()]
+    proxy_pool.retain({profile.session_token for user_profiles in profiles for profile in user_profiles})
+    await proxy_pool.check(config.get(config.NINTENDO_REQUEST_TIMEOUT))
+
+
+async def notify_quarantined(context: ContextTypes.DEFAULT_TYPE, chat_id: int, profile: Profile):
+    """tell the user once per quarantine that background updates of the profile are paused."""
+    if profile.quarantine_notified:
+        return
+    profile.quarantine_notified = True
+    await cluster.publish_profile(profile)
+    _ = translator(profile)
+    text = _('Failed to refresh the Nintendo login of profile <b>[{name}]</b> repeatedly. Background updates are paused and will be retried later. If the login was revoked, please add the profile again.').format(name=profile.name)
+    outbox.send(context.bot, chat_id, text)
+
 
-    version = await nintendo.login.update_webview_version()
-    logger.info(f'Updated webview version. version = {version}')
+def notice_chat(context: ContextTypes.DEFAULT_TYPE, user: int) -> Optional[int]:
+    """the chat of the user's monitor, or else the private chat the user started the bot in."""
+    for job_param in context.bot_data.get(BotData.MonitorJobs, set()):
+        if job_param.user_id == user:
+            return job_param.chat_id
+    return context.application.user_data[user].get(UserData.PrivateChat)
 
-    graphql_request_map = await nintendo.query.update_graphql_query_map()
-    logger.info(f'Updated GraphQL request map. map = {graphql_request_map}')
 
-    version = await nintendo.login.update_s3s_version()
-    logger.info(f'Updated s3s version. version = {version}')
+def keep_alive_slot(profile: Profile, slots: int) -> int:
+    return zlib.crc32(profile.session_token.encode('utf-8')) % slots
 
 
+@instrument_job
 async def keep_alive_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    refresh the profiles of one slot. profiles are spread over `slots` slots by their session token,
+    and the job runs once per slot, so each profile is kept alive once per interval without a burst.
+    """
+    interval = config.get(config.NINTENDO_TOKEN_UPDATE_INTERVAL)
+    slots = config.get(config.NINTENDO_KEEP_ALIVE_SLOTS)
+    width = interval / slots
+    # the slot comes from the time this run was scheduled for, which is one slot width before the next run,
+    # so neither a late start nor the deferral below moves it into the next slot
+    next_t = context.job.next_t
+    scheduled = next_t.timestamp() - width if next_t is not None else time.time()
+    slot = round(scheduled / width) % slots
+    await overload.wait_below('keep_alive_job', ShedLevel.Elevated, config.get(config.OVERLOAD_MAX_DEFER))
+    semaphore = asyncio.Semaphore(config.get(config.NINTENDO_KEEP_ALIVE_CONCURRENCY))
+
+    async def keep_alive(user: int, profile: Profile):
+        if profile.quarantined:
+            keep_alive_runs.inc(result='quarantined')
+            chat_id = notice_chat(context, user)
+            if chat_id is not None:
+                await notify_quarantined(context, chat_id, profile)
+            return
+        if time.monotonic() - last_success.get(profile.session_token, -interval) < interval:
+            keep_alive_runs.inc(result='skipped')
+            return
+        async with semaphore:
+            try:
+                await home(profile)
+                keep_alive_runs.inc(result='success')
+            except Exception as e:
+                keep_alive_runs.inc(result='error')
+                logger.error(f'Failed to keep profile alive. user = {user}, profile = {profile.name}, error = {e}')
+
     tasks = []
     registered_users: set = context.bot_data[BotData.RegisteredUsers]
     for user in registered_users:
+        if not cluster.owns(user):
+            continue
         profiles = context.application.user_data[user][UserData.Profiles].values()
         for profile in profiles:
-            tasks.append(home(profile))
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    exceptions = [f'{r}' for r in results if isinstance(r, Exception)]
-    if len(exceptions) > 0:
-        raise RuntimeError('\n'.join(exceptions))
+            if keep_alive_slot(profile, slots) == slot:
+                tasks.append(keep_alive(user, profile))
+    with deadline.scope(config.get(config.DEADLINE_JOB)):
+        await asyncio.gather(*tasks)
+
 
+async def _retry_update_schedule_images(context: ContextTypes.DEFAULT_TYPE):
+    _retry_skipped_run(context, update_schedule_images_job)
 
+
+@instrument_job
+@leases.singleton(follower=_retry_update_schedule_images)
 async def update_schedule_images_job(context: ContextTypes.DEFAULT_TYPE):
-    registered_users: set = context.bot_data[BotData.RegisteredUsers]
-    if len(registered_users) == 0:
-        logger.error(f'No registered users for stage query.')
-    profiles = [
-        p
-        for user in registered_users if len(context.application.user_data[user][UserData.Profiles]) > 0
-        for p in context.application.user_data[user][UserData.Profiles].values()
-    ]
+    await overload.wait_below('update_schedule_images_job', ShedLevel.Critical, config.get(config.OVERLOAD_MAX_DEFER))
+    with deadline.scope(config.get(config.DEADLINE_JOB)):
+        await _update_schedule_images(context)
+
+
+async def _update_schedule_images(context: ContextTypes.DEFAULT_TYPE):
+    profiles = service_profiles(context.application)
     if len(profiles) == 0:
         raise RuntimeError(f'No profiles for stage query.')
-    profile = profiles[0]
-
-    resp = await stage_schedule(profile)
+    resp, profile = await pool.run(profiles, stage_schedule)
+    # uploads to the storage channel must happen once, so make sure no other replica took over meanwhile
+    await leases.check()
     await update_schedule_image(resp, profile, context, force=False)
 
 
 def init_jobs(application: Application):
-    application.job_queue.run_custom(
-        update_nso_version_job,
-        job_kwargs={
-            'trigger': 'interval',
-            'seconds': config.get(config.NINTENDO_VERSION_UPDATE_INTERVAL),
-            'next_run_time': datetime.datetime.now().astimezone(pytz.UTC),
-            'misfire_grace_time': None,
-        }
-    )
+    application.job_queue.scheduler.add_listener(functools.partial(_job_submitted, application), EVENT_JOB_SUBMITTED)
+    version_interval = config.get(config.NINTENDO_VERSION_UPDATE_INTERVAL)
+    # the persisted registry is good enough to start with, so only refresh it at boot when it is stale
+    version_next_run = datetime.datetime.now().astimezone(pytz.UTC)
+    if registry.fresh(version_interval):
+        version_next_run = datetime.datetime.fromtimestamp(registry.updated_at + version_interval, pytz.UTC)
+    # shared work stays on the frontend, workers only pick up its results
+    if cluster.role != Role.Worker:
+        application.job_queue.run_custom(
+            update_nso_version_job,
+            job_kwargs={
+                'trigger': 'interval',
+                'seconds': version_interval,
+                'next_run_time': version_next_run,
+                'misfire_grace_time': None,
+            }
+        )
     application.job_queue.run_custom(
         keep_alive_job,
         job_kwargs={
             'trigger': 'interval',
-            'seconds': config.get(config.NINTENDO_TOKEN_UPDATE_INTERVAL),
-            'next_run_time': datetime.datetime.now().astimezone(pytz.UTC),
-            'misfire_grace_time': None,
-        }
-    )
-    application.job_queue.run_custom(
-        update_schedule_images_job,
-        job_kwargs={
-            'trigger': 'cron',
-            'hour': '*/2',
-            'minute': '0',
-            'second': '5',
-            'timezone': datetime.timezone.utc,
+            'seconds': config.get(config.NINTENDO_TOKEN_UPDATE_INTERVAL) / config.get(config.NINTENDO_KEEP_ALIVE_SLOTS),
             'next_run_time': datetime.datetime.now().astimezone(pytz.UTC),
             'misfire_grace_time': None,
         }
     )
-    application.job_queue.run_custom(
-        recover_monitor_jobs,
-        job_kwargs={
-            'run_date': datetime.datetime.now().astimezone(pytz.UTC) + datetime.timedelta(seconds=config.get(config.NINTENDO_MONITOR_INTERVAL)),
-            'misfire_grace_time': None,
-        })
+    if cluster.role != Role.Worker:
+        application.job_queue.run_custom(
+            update_schedule_images_job,
+            job_kwargs={
+                'trigger': 'cron',
+                'hour': '*/2',
+                'minute': '0',
+                'second': '5',
+                'timezone': datetime.timezone.utc,
+                'next_run_time': datetime.datetime.now().astimezone(pytz.UTC),
+                'misfire_grace_time': None,
+            }
+        )
+    if len(proxy_pool.proxies) > 0:
+        application.job_queue.run_custom(
+            check_proxies_job,
+            job_kwargs={
+                'trigger': 'interval',
+                'seconds': config.get(config.NINTENDO_PROXY_CHECK_INTERVAL),
+                'next_run_time': datetime.datetime.now().astimezone(pytz.UTC),
+                'misfire_grace_time': None,
+            }
+        )
+    if cluster.enabled:
+        application.job_queue.run_custom(
+            cluster_sync_job,
+            job_kwargs={
+                'trigger': 'interval',
+                'seconds': config.get(config.CLUSTER_SYNC_INTERVAL),
+                'next_run_time': datetime.datetime.now().astimezone(pytz.UTC) + datetime.timedelta(seconds=config.get(config.CLUSTER_SYNC_INTERVAL)),
+                'misfire_grace_time': None,
+            }
+        )
+    else:
+        application.job_queue.run_custom(
+            recover_monitor_jobs,
+            job_kwargs={
+                'run_date': datetime.datetime.now().astimezone(pytz.UTC) + datetime.timedelta(seconds=config.get(config.NINTENDO_MONITOR_INTERVAL)),
+                'misfire_grace_time': None,
+            })
     application.add_handlers(handlers)
 
 
@@ -1,18 +1,25 @@
+import asyncio
 import functools
 import inspect
 import logging
+import time
 
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
 
+import config
 import nintendo.login
 import nintendo.query
 from bot.battles import _message_battle_detail, BattleParser
+from bot.cluster import cluster
 from bot.coops import CoopParser, _message_coop_detail
 from bot.data import Profile, UserData
 from bot.utils import whitelist_filter
 from locales import _
-from nintendo.utils import ExpiredTokenError
+from nintendo.proxy import proxy_pool
+from nintendo.utils import ExpiredTokenError, NintendoError, ProfileQuarantinedError
+from utils import deadline
+from utils.tracing import tracer
 
 logger = logging.getLogger('bot.nintendo')
 
@@ -29,24 +36,132 @@ async def update_token(profile: Profile):
     profile.country = user_country
 
 
-def auto_update_profile(fn):
-    @functools.wraps(fn)
-    async def wrapper(*args, **kwargs):
+def record_login_failure(profile: Profile):
+    profile.failures += 1
+    threshold = config.get(config.NINTENDO_QUARANTINE_THRESHOLD)
+    if profile.failures >= threshold:
+        backoff = min(config.get(config.NINTENDO_QUARANTINE_BASE) * 2 ** (profile.failures - threshold), config.get(config.NINTENDO_QUARANTINE_MAX))
+        profile.quarantined_until = time.time() + backoff
+        profile.quarantine_notified = False
+        logger.warning(f'Quarantined profile. profile = {profile.name}, failures = {profile.failures}, seconds = {backoff}')
+
+
+def record_login_success(profile: Profile):
+    if profile.failures > 0:
+        logger.info(f'Profile recovered. profile = {profile.name}, failures = {profile.failures}')
+    profile.failures = 0
+    profile.quarantined_until = 0
+    profile.quarantine_notified = False
+
+
+async def _refresh_token(profile: Profile):
+    try:
+        with tracer.span('update_token'):
+            await update_token(profile)
+    except NintendoError as e:
+        record_login_failure(profile)
+        await cluster.publish_profile(profile)
+        logger.error(f'Failed to update user profile. profile = {profile}, error = {e}')
+        raise
+    except Exception as e:
+        logger.error(f'Failed to update user profile. profile = {profile}, error = {e}')
+        raise
+    record_login_success(profile)
+    # other processes of a cluster use the new tokens too, instead of logging in again
+    await cluster.publish_profile(profile)
+
+
+# refreshes in flight by session token, shared by the callers that find the same profile expired
+refreshing: dict[str, asyncio.Task] = {}
+# session tokens of profiles whose quarantine ended and whose login is being probed by one call
+probing: set[str] = set()
+
+
+def _refreshed(session_token: str, task: asyncio.Task):
+    if refreshing.get(session_token) is task:
+        del refreshing[session_token]
+    # retrieve the exception, in case every caller was cancelled and nobody else will
+    if not task.cancelled():
+        task.exception()
+
+
+async def refresh_token(profile: Profile):
+    """
+    refresh the tokens in a task of its own, under the login deadline instead of the caller's.
+    a command whose reply runs out of time stops waiting, but the refresh goes on and stores the new tokens,
+    so the next command does not start over. callers arriving while a refresh is in flight wait for it.
+    """
+    task = refreshing.get(profile.session_token)
+    if task is None:
+        with deadline.replace(config.get(config.DEADLINE_LOGIN)):
+            task = asyncio.ensure_future(_refresh_token(profile))
+        refreshing[profile.session_token] = task
+        task.add_done_callback(functools.partial(_refreshed, profile.session_token))
+    await asyncio.shield(task)
+
+
+def on_probation(profile: Profile) -> bool:
+    """the quarantine ended, but no login succeeded since."""
+    return not profile.quarantined and profile.failures >= config.get(config.NINTENDO_QUARANTINE_THRESHOLD)
+
+
+async def _call(profile: Profile, fn, args: tuple, kwargs: dict):
+    with proxy_pool.pinned(profile.session_token):
         try:
             return await fn(*args, **kwargs)
         except ExpiredTokenError as e:
-            args_name: list = inspect.getfullargspec(fn)[0]
-            idx = args_name.index('profile')
-            profile = args[idx]
             logger.warning(f'Profile is expired. profile = {profile}, error = {e}')
-            try:
-                await update_token(profile)
-            except Exception as e:
-                logger.error(f'Failed to update user profile. profile = {profile}, error = {e}')
-                raise
+            await refresh_token(profile)
             return await fn(*args, **kwargs)
-        except:
-            raise
+
+
+def auto_update_profile(fn):
+    """
+    refresh the tokens of the profile if they are expired.
+    a profile whose login keeps failing is quarantined: calls fail fast with ProfileQuarantinedError until
+    the quarantine ends, then one call probes the login again and doubles the quarantine if it still fails.
+    the calls arriving while the probe is in flight keep failing with ProfileQuarantinedError.
+    the requests of the call go through the proxy the profile is pinned to.
+    """
+    idx = inspect.getfullargspec(fn)[0].index('profile')
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        profile: Profile = kwargs['profile'] if 'profile' in kwargs else args[idx]
+        if profile.quarantined:
+            raise ProfileQuarantinedError(f'Profile is quarantined. profile = {profile.name}')
+        if not on_probation(profile):
+            return await _call(profile, fn, args, kwargs)
+        # the others fail fast until the probe is done, also while the probe's refresh outlives a cancelled probe
+        if profile.session_token in probing or profile.session_token in refreshing:
+            raise ProfileQuarantinedError(f'Profile login is being probed. profile = {profile.name}')
+        probing.add(profile.session_token)
+        try:
+            data = await _call(profile, fn, args, kwargs)
+        finally:
+            probing.discard(profile.session_token)
+        # the tokens worked without a refresh, so the login is fine again
+        if on_probation(profile):
+            record_login_success(profile)
+            await cluster.publish_profile(profile)
+        return data
+
+    return wrapper
+
+
+# monotonic time of the last successful query by session token, so keep-alive can skip profiles in use
+last_success: dict[str, float] = {}
+
+
+def track_success(fn):
+    idx = list(inspect.signature(fn).parameters).index('profile')
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        data = await fn(*args, **kwargs)
+        profile: Profile = kwargs['profile'] if 'profile' in kwargs else args[idx]
+        last_success[profile.session_token] = time.monotonic()
+        return data
 
     return wrapper
 
@@ -61,42 +176,55 @@ def auto_logging(fn):
     return wrapper
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def home(profile: Profile) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.HomeQuery, varname='naCountry', varvalue=profile.country)
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def stage_schedule(profile: Profile) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.StageScheduleQuery)
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def battles(profile: Profile) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.LatestBattleHistoriesQuery)
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def coops(profile: Profile) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.CoopHistoryQuery)
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def battle_detail(profile: Profile, vs_id: str) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.VsHistoryDetailQuery, varname='vsResultId', varvalue=vs_id)
 
 
+@tracer.traced
 @auto_logging
+@track_success
 @auto_update_profile
 async def coop_detail(profile: Profile, coop_id: str) -> str:
     return await nintendo.query.do_query(profile.gtoken, profile.bullet_token, profile.language, profile.country, nintendo.query.QueryKey.CoopHistoryDetailQuery, varname='coopHistoryDetailId', varvalue=coop_id)
 
 
+@tracer.traced
 async def download_image(profile: Profile, url: str) -> bytes:
     return await nintendo.query.download_image(profile.gtoken, profile.bullet_token, profile.language, profile.country, url)
 
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+
+import config
+from utils import metrics
+from utils.tracing import Span, current_span, tracer
+
+logger = logging.getLogger('bot.outbox')
+
+messages_dropped = metrics.counter('outbox_messages_dropped_total', 'Merged messages that failed to send, by error.', ('error',))
+
+
+@dataclass
+class Queued:
+    text: str
+    # the span the text was queued under, so its send is traced as part of the same tick
+    span: Optional[Span]
+    queued_at: float
+
+
+class Outbox:
+    """
+    Per-chat outbound queue. Messages sent to the same chat within `window` seconds are merged
+    into as few messages as the length limit allows, and delivered in the order they were sent.
+    Sends are retried below, by BackoffRetryRequest for network errors and by the rate limiter for flood control;
+    a message failing anyway is counted as dropped. `close` flushes what is left without waiting for the window.
+    """
+
+    def __init__(self, window: float, separator: str = '\n\n'):
+        self.window = window
+        self.separator = separator
+        self._pending: dict[int, list[Queued]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        # texts queued and not yet sent or dropped, including the ones being sent
+        self._depth = 0
+        # created on first use, inside the running loop
+        self._closing: Optional[asyncio.Event] = None
+
+    @property
+    def depth(self) -> int:
+        """number of texts not delivered yet, counting the ones of the message being sent."""
+        return self._depth
+
+    def send(self, bot: Bot, chat_id: int, text: str):
+        self._pending.setdefault(chat_id, []).append(Queued(text, current_span.get(), time.monotonic()))
+        self._depth += 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush(bot, chat_id))
+
+    def merge(self, queued: list[Queued]) -> list[tuple[str, list[Queued]]]:
+        """merged messages, each with the queued texts it is made of."""
+        messages = []
+        for item in queued:
+            if len(messages) > 0 and len(messages[-1][0]) + len(self.separator) + len(item.text) <= MessageLimit.MAX_TEXT_LENGTH:
+                messages[-1] = (messages[-1][0] + self.separator + item.text, messages[-1][1] + [item])
+            else:
+                messages.append((item.text, [item]))
+        return messages
+
+    async def close(self):
+        """send the pending messages now, e.g. on shutdown, while the bot can still send."""
+        self._closing_event().set()
+        if len(self._tasks) > 0:
+            logger.info(f'Flushing outbox on close. chats = {len(self._tasks)}, texts = {self.depth}')
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _closing_event(self) -> asyncio.Event:
+        if self._closing is None:
+            self._closing = asyncio.Event()
+        return self._closing
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._closing_event().wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _flush(self, bot: Bot, chat_id: int):
+        # texts popped from pending and not sent yet, uncounted from the depth if the task is cancelled
+        unsent = 0
+        try:
+            while True:
+                await self._wait()
+                queued = self._pending.pop(chat_id, [])
+                unsent = len(queued)
+                if len(queued) == 0:
+                    break
+                messages = self.merge(queued)
+                logger.debug(f'Flushing outbox. chat_id = {chat_id}, texts = {len(queued)}, messages = {len(messages)}')
+                for message, items in messages:
+                    # this task runs in the context of whichever tick created it, trace the send under the tick
+                    # that queued the first text of the message instead
+                    token = current_span.set(items[0].span)
+                    try:
+                        with tracer.span('send_message', chat_id=chat_id, texts=len(items), queued_seconds=f'{time.monotonic() - items[0].queued_at:.3f}'):
+                            await bot.send_message(chat_id=chat_id, text=message)
+                    except Exception as e:
+                        messages_dropped.inc(error=type(e).__name__)
+                        logger.error(f'Failed to send message, dropped it. chat_id = {chat_id}, error = {e}')
+                    finally:
+                        current_span.reset(token)
+                        self._depth -= len(items)
+                        unsent -= len(items)
+        finally:
+            self._depth -= unsent
+            self._tasks.pop(chat_id, None)
+
+
+outbox = Outbox(window=config.get(config.BOT_OUTBOX_WINDOW))
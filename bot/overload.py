@@ -0,0 +1,80 @@
+import asyncio
+import enum
+import logging
+import time
+from typing import Optional
+
+import config
+from bot.outbox import outbox
+from utils import metrics
+from utils.watchdog import watchdog
+
+logger = logging.getLogger('bot.overload')
+
+shed_level = metrics.gauge('shed_level', 'Current load shedding level. 0 = normal, 1 = elevated, 2 = critical.')
+shed_ticks = metrics.counter('shed_ticks_total', 'Background job runs skipped or deferred by load shedding.', ('job',))
+
+
+class ShedLevel(enum.IntEnum):
+    Normal = 0
+    Elevated = 1
+    Critical = 2
+
+
+class OverloadController:
+    """
+    Derives a shed level from event loop lag and outbox depth. Only background jobs consult it:
+    monitor ticks are stretched, keep-alive and schedule uploads wait for the load to drop.
+    User-initiated commands are never shed.
+    """
+
+    def __init__(self, lag_thresholds: list[float], depth_thresholds: list[int], monitor_stretch: list[int], interval: float = 1.0):
+        self.lag_thresholds = lag_thresholds
+        self.depth_thresholds = depth_thresholds
+        self.monitor_stretch = monitor_stretch
+        self.interval = interval
+        self.level = ShedLevel.Normal
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def evaluate(self) -> ShedLevel:
+        lag_level = sum(1 for t in self.lag_thresholds if watchdog.lag >= t)
+        depth_level = sum(1 for t in self.depth_thresholds if outbox.depth >= t)
+        return ShedLevel(min(max(lag_level, depth_level), ShedLevel.Critical))
+
+    async def _run(self):
+        while True:
+            level = self.evaluate()
+            if level != self.level:
+                logger.warning(f'Shed level changed. level = {level.name}, lag = {watchdog.lag:.3f}s, outbox_depth = {outbox.depth}')
+                self.level = level
+                shed_level.set(int(level))
+            await asyncio.sleep(self.interval)
+
+    def should_skip_tick(self, job: str, last_tick: float, interval: float) -> bool:
+        """whether a periodic tick should be skipped, stretching its interval by the factor of the current level."""
+        stretch = self.monitor_stretch[self.level]
+        # a bit of slack, so a tick that fires slightly early is not skipped
+        if stretch > 1 and time.monotonic() - last_tick < interval * (stretch - 0.5):
+            shed_ticks.inc(job=job)
+            return True
+        return False
+
+    async def wait_below(self, job: str, level: ShedLevel, timeout: float):
+        """defer a job until the shed level drops below `level`, but at most `timeout` seconds."""
+        if self.level < level:
+            return
+        shed_ticks.inc(job=job)
+        logger.info(f'Deferring job. job = {job}, level = {self.level.name}')
+        deadline = time.monotonic() + timeout
+        while self.level >= level and time.monotonic() < deadline:
+            await asyncio.sleep(self.interval)
+
+
+overload = OverloadController(
+    lag_thresholds=config.get(config.OVERLOAD_LAG_THRESHOLDS),
+    depth_thresholds=config.get(config.OVERLOAD_DEPTH_THRESHOLDS),
+    monitor_stretch=config.get(config.OVERLOAD_MONITOR_STRETCH),
+)
@@ -0,0 +1,96 @@
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+from telegram.ext import Application
+
+from bot.data import BotData, UserData, Profile
+from bot.nintendo import last_success
+from utils import metrics
+
+logger = logging.getLogger('bot.pool')
+
+pool_requests = metrics.counter('profile_pool_requests_total', 'Shared queries run through the profile pool by result.', ('result',))
+
+T = TypeVar('T')
+
+# a profile unused for this long probably needs a token refresh first, which costs about LOGIN_PENALTY seconds
+FRESHNESS = 60 * 60
+LOGIN_PENALTY = 5.0
+
+
+@dataclass
+class ProfileHealth:
+    latency: float = 1.0
+    error_rate: float = 0.0
+
+
+class ProfilePool:
+    """
+    Picks profiles for shared, non-user-specific queries like the stage schedule.
+    Profiles are scored by the EWMA of their latency and error rate and by how fresh their tokens are.
+    The better of two randomly sampled profiles is tried first (power of two choices, so load is spread over
+    healthy profiles), then the others by score until `attempts` profiles have failed.
+    """
+
+    def __init__(self, alpha: float = 0.3, attempts: int = 3):
+        self.alpha = alpha
+        self.attempts = attempts
+        self._health: dict[str, ProfileHealth] = {}
+
+    def health(self, profile: Profile) -> ProfileHealth:
+        return self._health.setdefault(profile.session_token, ProfileHealth())
+
+    def score(self, profile: Profile) -> float:
+        """expected cost of a query in seconds, lower is better."""
+        health = self.health(profile)
+        fresh = time.monotonic() - last_success.get(profile.session_token, -FRESHNESS) < FRESHNESS
+        return health.latency * (1 + 4 * health.error_rate) + (0 if fresh else LOGIN_PENALTY)
+
+    def order(self, profiles: list[Profile]) -> list[Profile]:
+        ranked = sorted(profiles, key=self.score)
+        if len(ranked) >= 2:
+            first = min(random.sample(ranked, 2), key=self.score)
+            ranked.remove(first)
+            ranked.insert(0, first)
+        return ranked
+
+    def _observe(self, profile: Profile, seconds: float, failed: bool):
+        health = self.health(profile)
+        health.latency += self.alpha * (seconds - health.latency)
+        health.error_rate += self.alpha * (failed - health.error_rate)
+
+    async def run(self, profiles: list[Profile], fn: Callable[[Profile], Awaitable[T]]) -> tuple[T, Profile]:
+        """run `fn` with the best profile, failing over to the next ones. returns the result and the profile used."""
+        if len(profiles) == 0:
+            raise RuntimeError('No profiles in the pool.')
+        error = None
+        for profile in self.order(profiles)[:self.attempts]:
+            start = time.monotonic()
+            try:
+                result = await fn(profile)
+            except Exception as e:
+                self._observe(profile, time.monotonic() - start, True)
+                pool_requests.inc(result='failover')
+                logger.warning(f'Shared query failed, failing over. profile = {profile.name}, error = {e}')
+                error = e
+                continue
+            self._observe(profile, time.monotonic() - start, False)
+            pool_requests.inc(result='success')
+            return result, profile
+        pool_requests.inc(result='error')
+        raise error
+
+
+def service_profiles(application: Application) -> list[Profile]:
+    """the profiles of all registered users that may serve shared queries."""
+    return [
+        p
+        for user in application.bot_data[BotData.RegisteredUsers]
+        for p in application.user_data[user].get(UserData.Profiles, {}).values() if not p.quarantined
+    ]
+
+
+pool = ProfilePool()
@@ -11,8 +11,9 @@ import config
 import locales
 import nintendo.login
 import nintendo.utils
+from nintendo.proxy import proxy_pool
 from bot.data import UserData, Profile
-from bot.utils import CallbackData, whitelist_filter, translator, current_profile
+from bot.utils import CallbackData, whitelist_filter, translator, current_profile, with_deadline
 
 
 class ProfileButtonCallback:
@@ -44,6 +45,7 @@ def init_user_data(context: ContextTypes.DEFAULT_TYPE):
     context.user_data.setdefault(UserData.MessageID_Timezone, '')
     context.user_data.setdefault(UserData.LastBattle, None)
     context.user_data.setdefault(UserData.LastCoop, None)
+    context.user_data.setdefault(UserData.PrivateChat, None)
 
 
 async def profile_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -204,6 +206,7 @@ async def profile_input_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ProfileAddingState.Link
 
 
+@with_deadline(config.DEADLINE_LOGIN)
 async def profile_input_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     _ = translator(current_profile(context))
     message = await update.message.reply_text(text=_('Processing your link...'))
@@ -213,8 +216,9 @@ async def profile_input_link(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     try:
         session_token = await nintendo.login.get_session_token(auth_code_verifier, link)
-        web_service_token, user_nickname, user_lang, user_country = await nintendo.login.get_gtoken(session_token)
-        bullet_token = await nintendo.login.get_bullet(web_service_token, user_lang, user_country)
+        with proxy_pool.pinned(session_token):
+            web_service_token, user_nickname, user_lang, user_country = await nintendo.login.get_gtoken(session_token)
+            bullet_token = await nintendo.login.get_bullet(web_service_token, user_lang, user_country)
     except nintendo.utils.NintendoError as e:
         await update.message.reply_text(text=_('Failed to get your Nintendo token. Please retry.\nerror = {error}').format(error=e))
         return ProfileAddingState.Link
@@ -362,6 +366,7 @@ async def profile_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     deleted_profile_id: int = int(ProfileButtonCallback.Delete.decode(query.data))
     deleted_profile: Profile = context.user_data[UserData.Profiles][deleted_profile_id]
     del context.user_data[UserData.Profiles][deleted_profile_id]
+    proxy_pool.unpin(deleted_profile.session_token)
     if context.user_data[UserData.Current] == deleted_profile_id:
         sorted_profiles = sorted(context.user_data[UserData.Profiles].keys())
         if len(sorted_profiles) > 0:
@@ -1,24 +1,32 @@
 import asyncio
 import datetime
+import hashlib
 import json
 import logging
 import re
 from itertools import groupby
-from typing import Callable
+from typing import Callable, TYPE_CHECKING
 
-import cv2
-import numpy as np
 import pytz
-from telegram import Update
-from telegram.ext import ContextTypes, CommandHandler, Application
+from telegram import Update, InputMediaPhoto, InlineQueryResultCachedPhoto
+from telegram.constants import ParseMode
+from telegram.ext import ContextTypes, CommandHandler, Application, InlineQueryHandler
 
 import config
-from bot.data import Schedules, BattleSchedule, CoopSchedule, Stage, BotData, Profile, ModeEnum, RuleEnum, BattleSetting, Rule, CoopSetting, CommonParser, Mode
+import nintendo.utils
+from bot.data import Schedules, BattleSchedule, CoopSchedule, Stage, BotData, Profile, ModeEnum, RuleEnum, BattleSetting, Rule, CoopSetting, CommonParser, Mode, UserData
 from bot.nintendo import download_image, stage_schedule
-from bot.utils import whitelist_filter, current_profile, format_schedule_time, translator
+from bot.utils import whitelist_filter, current_profile, format_schedule_time, translator, with_deadline
+
+if TYPE_CHECKING:
+    import numpy as np
 
 logger = logging.getLogger('bot.schedules')
 
+MEDIA_GROUP_LIMIT = 10
+INLINE_RESULT_LIMIT = 50
+INLINE_COOP_CACHE_TIME = 60
+
 
 class ScheduleParser:
     @staticmethod
@@ -124,7 +132,11 @@ class ScheduleParser:
         )
 
 
-def bytes_to_image(data: bytes) -> np.ndarray:
+def bytes_to_image(data: bytes) -> 'np.ndarray':
+    # cv2 and numpy are only needed for compositing, import them lazily to keep startup fast
+    import cv2
+    import numpy as np
+
     buf = np.asarray(bytearray(data), dtype=np.uint8)
     img = cv2.imdecode(buf, -1)
     return img
@@ -135,6 +147,8 @@ def battle_key(battle_stages: tuple[Stage, Stage]) -> str:
 
 
 async def upload_battle_image(battle_stages: tuple[Stage, Stage], context: ContextTypes.DEFAULT_TYPE):
+    import cv2
+
     stage_cache: dict[str, bytes] = context.bot_data[BotData.StageImageIDs]
     battle_cache: dict[str, str] = context.bot_data[BotData.BattleImageIDs]
 
@@ -154,10 +168,35 @@ async def upload_battle_image(battle_stages: tuple[Stage, Stage], context: Conte
 
 
 def coop_key(coop: CoopSchedule) -> str:
+    """keyed by content, so rotations sharing the same stage and weapons reuse one image."""
+    weapons = '_'.join(weapon.id or weapon.image_url.split('?')[0] for weapon in coop.setting.weapons)
+    digest = hashlib.sha1(weapons.encode('utf-8')).hexdigest()
+    return f'coop_{coop.setting.stage.id}_{digest}'
+
+
+def legacy_coop_key(coop: CoopSchedule) -> str:
     return f'coop_{coop.setting.rule.id}_{coop.start_time.timestamp()}'
 
 
+legacy_coop_key_regex = re.compile(r'^coop_.+_\d+\.\d+$')
+
+
+def migrate_coop_image_ids(coops: list[CoopSchedule], coop_cache: dict[str, str]):
+    """move file ids stored under timestamp keys to content keys, and drop the rest of timestamp keys."""
+    for coop in coops:
+        file_id = coop_cache.pop(legacy_coop_key(coop), None)
+        if file_id is not None:
+            coop_cache.setdefault(coop_key(coop), file_id)
+    legacy_keys = [key for key in coop_cache if legacy_coop_key_regex.match(key)]
+    for key in legacy_keys:
+        del coop_cache[key]
+    if len(legacy_keys) > 0:
+        logger.info(f'Dropped legacy coop image ids. number = {len(legacy_keys)}')
+
+
 async def upload_coop_image(coop: CoopSchedule, profile: Profile, context: ContextTypes.DEFAULT_TYPE):
+    import cv2
+
     coop_cache: dict[str, str] = context.bot_data[BotData.CoopImageIDs]
 
     download_tasks = [download_image(profile, coop.setting.stage.image_url)]
@@ -185,6 +224,7 @@ async def update_schedule_image(data: str, profile: Profile, context: ContextTyp
         stage_cache.clear()
         battle_cache.clear()
         coop_cache.clear()
+    context.bot_data[BotData.Schedules] = data
 
     download_tasks = []
     stage_ids = []
@@ -205,6 +245,9 @@ async def update_schedule_image(data: str, profile: Profile, context: ContextTyp
             upload_battle_tasks.append(upload_battle_image(battle_stage, context))
 
     coops = [coop for coop in schedules.coop_regular + schedules.coop_team_contest]
+    migrate_coop_image_ids(coops, coop_cache)
+    # distinct content
+    coops = list({coop_key(coop): coop for coop in coops}.values())
     upload_coop_tasks = []
     for coop in coops:
         if coop_key(coop) not in coop_cache:
@@ -220,20 +263,13 @@ async def update_schedule_image(data: str, profile: Profile, context: ContextTyp
 
 
 class BattleQueryFilter:
-    regexp = r'([rcox]+( [talgc]+)?)?( |^)(\d{1,2}( \d{0,2})?)?'
+    regexp = r'([rcox]+( [talgc]+)?)?((^| )\d{1,2}( \d{1,2})?)?'
     __compiled = re.compile(regexp)
 
     @staticmethod
     def validate(args: list[str]) -> bool:
-        text = ' '.join(args)
-        if text == '':
-            return True
-        match = BattleQueryFilter.__compiled.match(text)
-        if match is None:
-            return False
-        if len(match.group()) == 0:
-            return False
-        return True
+        # the whole text has to match, since `filter` parses every argument, e.g. int('1x') would raise
+        return BattleQueryFilter.__compiled.fullmatch(' '.join(args)) is not None
 
     @staticmethod
     def filter(args: list[str], schedules: Schedules, tz: datetime.tzinfo) -> list[BattleSchedule]:
@@ -309,12 +345,15 @@ class BattleQueryFilter:
         return ordered_schedules
 
 
-async def output_battle_schedule(schedule: BattleSchedule, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    profile = current_profile(context)
+def battle_schedule_photo(schedule: BattleSchedule, profile: Profile, context: ContextTypes.DEFAULT_TYPE) -> InputMediaPhoto:
     _ = translator(profile)
     battle_cache: dict[str, str] = context.bot_data[BotData.BattleImageIDs]
     file_id = battle_cache[battle_key(schedule.setting.stage)]
-    text = '\n'.join([
+    return InputMediaPhoto(media=file_id, caption=_message_battle_schedule(_, schedule, profile), parse_mode=ParseMode.HTML)
+
+
+def _message_battle_schedule(_: Callable[[str], str], schedule: BattleSchedule, profile: Profile) -> str:
+    return '\n'.join([
         _('Time: <code>{start_time}</code> ~ <code>{end_time}</code>'),
         _('Mode: <code>{mode}</code>'),
         _('Stage:'),
@@ -329,9 +368,19 @@ async def output_battle_schedule(schedule: BattleSchedule, update: Update, conte
         stage_2=schedule.setting.stage[1].name,
         rule=schedule.setting.rule.name,
     )
-    await update.message.reply_photo(photo=file_id, caption=text)
 
 
+async def reply_schedule_photos(photos: list[InputMediaPhoto], update: Update):
+    """reply photos in as few requests as possible, keeping their order."""
+    for i in range(0, len(photos), MEDIA_GROUP_LIMIT):
+        group = photos[i:i + MEDIA_GROUP_LIMIT]
+        if len(group) == 1:
+            await update.message.reply_photo(photo=group[0].media, caption=group[0].caption)
+        else:
+            await update.message.reply_media_group(media=group)
+
+
+@with_deadline(config.DEADLINE_COMMAND)
 async def battle_schedule_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     profile = current_profile(context)
     _ = translator(profile)
@@ -344,8 +393,8 @@ async def battle_schedule_query(update: Update, context: ContextTypes.DEFAULT_TY
     filtered_schedules = BattleQueryFilter.filter(args, schedules, pytz.timezone(profile.timezone))
     if len(filtered_schedules) == 0:
         await update.message.reply_text(text=_("No matching schedules after filtering."))
-    for schedule in filtered_schedules:
-        await output_battle_schedule(schedule, update, context)
+    photos = [battle_schedule_photo(schedule, profile, context) for schedule in filtered_schedules]
+    await reply_schedule_photos(photos, update)
 
 
 def _message_battle_schedule_query_instruction(_: Callable[[str], str]):
@@ -385,13 +434,12 @@ def _message_battle_schedule_query_instruction(_: Callable[[str], str]):
 
 
 class CoopQueryFilter:
-    regexp = r'\d?'
+    regexp = r'(\d{1,2})?'
     __compiled = re.compile(regexp)
 
     @staticmethod
     def validate(args: list[str]) -> bool:
-        text = ' '.join(args)
-        return CoopQueryFilter.__compiled.match(text) is not None
+        return CoopQueryFilter.__compiled.fullmatch(' '.join(args)) is not None
 
     @staticmethod
     def filter(args: list[str], schedules: Schedules) -> list[CoopSchedule]:
@@ -403,11 +451,14 @@ class CoopQueryFilter:
         return [schedule for grouped_schedule in grouped_schedules[:N] for schedule in grouped_schedule[1]][::-1]
 
 
-async def output_coop_schedule(schedule: CoopSchedule, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    profile = current_profile(context)
+def coop_schedule_photo(schedule: CoopSchedule, profile: Profile, context: ContextTypes.DEFAULT_TYPE) -> InputMediaPhoto:
     _ = translator(profile)
     coop_cache: dict[str, str] = context.bot_data[BotData.CoopImageIDs]
     file_id = coop_cache[coop_key(schedule)]
+    return InputMediaPhoto(media=file_id, caption=_message_coop_schedule(_, schedule, profile), parse_mode=ParseMode.HTML)
+
+
+def _message_coop_schedule(_: Callable[[str], str], schedule: CoopSchedule, profile: Profile) -> str:
     if (schedule.start_time - datetime.datetime.now().astimezone(pytz.UTC)).total_seconds() >= 0:
         second = int((schedule.start_time - datetime.datetime.now().astimezone(pytz.UTC)).total_seconds())
         time_text = _('Job will start in {time}.')
@@ -423,7 +474,7 @@ async def output_coop_schedule(schedule: CoopSchedule, update: Update, context:
     rule = None
     if schedule.setting.rule != RuleEnum.CoopRegular:
         rule = _('<b>Rule</b>: <code>{rule}</code>').format(rule=_(schedule.setting.rule.name))
-    text = '\n'.join(filter(lambda s: s is not None, [
+    return '\n'.join(filter(lambda s: s is not None, [
         _('Time: <code>{start_time}</code> ~ <code>{end_time}</code>'),
         _('Stage: <code>{stage}</code>'),
         rule,
@@ -443,9 +494,9 @@ async def output_coop_schedule(schedule: CoopSchedule, update: Update, context:
         weapon_4=schedule.setting.weapons[3].name,
         remaining_text=time_text.format(time=time)
     )
-    await update.message.reply_photo(photo=file_id, caption=text)
 
 
+@with_deadline(config.DEADLINE_COMMAND)
 async def coop_schedule_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     profile = current_profile(context)
     _ = translator(profile)
@@ -458,8 +509,8 @@ async def coop_schedule_query(update: Update, context: ContextTypes.DEFAULT_TYPE
     filtered_schedules = CoopQueryFilter.filter(args, schedules)
     if len(filtered_schedules) == 0:
         await update.message.reply_text(text=_("No matching schedules after filtering."))
-    for schedule in filtered_schedules:
-        await output_coop_schedule(schedule, update, context)
+    photos = [coop_schedule_photo(schedule, profile, context) for schedule in filtered_schedules]
+    await reply_schedule_photos(photos, update)
 
 
 def _message_coop_schedule_query_instruction(_: Callable[[str], str]):
@@ -473,6 +524,45 @@ def _message_coop_schedule_query_instruction(_: Callable[[str], str]):
     ])
 
 
+async def inline_schedule_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """answer inline queries from the cached schedule and image ids only, without querying SplatNet."""
+    query = update.inline_query
+    if query.from_user.username not in whitelist_filter.whitelist:
+        await query.answer(results=[], cache_time=0, is_personal=True)
+        return
+    data: str = context.bot_data.get(BotData.Schedules)
+    if data is None:
+        await query.answer(results=[], cache_time=0, is_personal=True)
+        return
+    if len(context.user_data.get(UserData.Profiles, {})) > 0:
+        profile = current_profile(context)
+    else:
+        profile = Profile(language='English(US)', timezone='UTC')
+
+    now = int(datetime.datetime.now().astimezone(pytz.UTC).timestamp())
+    cache_time = nintendo.utils.next_update_timestamp(now) - now
+    args = query.query.split()
+    schedules = ScheduleParser.schedules(data)
+    photos = []
+    if len(args) > 0 and args[0].lower() == 'coop':
+        cache_time = min(cache_time, INLINE_COOP_CACHE_TIME)  # caption counts down to the start or end of the job
+        if CoopQueryFilter.validate(args[1:]):
+            for schedule in CoopQueryFilter.filter(args[1:], schedules):
+                if coop_key(schedule) in context.bot_data[BotData.CoopImageIDs]:
+                    photos.append(coop_schedule_photo(schedule, profile, context))
+    else:
+        if BattleQueryFilter.validate(args):
+            for schedule in BattleQueryFilter.filter(args, schedules, pytz.timezone(profile.timezone)):
+                if battle_key(schedule.setting.stage) in context.bot_data[BotData.BattleImageIDs]:
+                    photos.append(battle_schedule_photo(schedule, profile, context))
+
+    results = [
+        InlineQueryResultCachedPhoto(id=str(i), photo_file_id=photo.media, caption=photo.caption, parse_mode=ParseMode.HTML)
+        for i, photo in enumerate(photos[:INLINE_RESULT_LIMIT])
+    ]
+    await query.answer(results=results, cache_time=cache_time, is_personal=True)
+
+
 def init_schedules(application: Application):
     application.add_handlers(handlers)
 
@@ -480,4 +570,5 @@ def init_schedules(application: Application):
 handlers = [
     CommandHandler('schedules', battle_schedule_query, filters=whitelist_filter),
     CommandHandler('coop_schedules', coop_schedule_query, filters=whitelist_filter),
+    InlineQueryHandler(inline_schedule_query),
 ]
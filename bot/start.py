@@ -1,14 +1,18 @@
 from telegram import Update
+from telegram.constants import ChatType
 from telegram.ext import ContextTypes, CommandHandler
 
 from bot import profiles
-from bot.data import BotData
+from bot.data import BotData, UserData
 from bot.utils import whitelist_filter
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     profiles.init_user_data(context)
     context.bot_data[BotData.RegisteredUsers].add(update.message.from_user.id)
+    if update.effective_chat.type == ChatType.PRIVATE:
+        # background notices go here, when the user has no monitor running
+        context.user_data[UserData.PrivateChat] = update.effective_chat.id
     await profiles.profile_manage(update, context)
 
 handlers = [
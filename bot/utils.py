@@ -1,11 +1,14 @@
+import asyncio
 import datetime
+import functools
 import gettext
+import logging
 import re
-import sys
+import time
 from dataclasses import dataclass
 from typing import Tuple, Optional, Callable
 
-from telegram import Message
+from telegram import Message, Update
 from telegram._utils.types import ODVInput
 from telegram.ext import ContextTypes
 from telegram.ext.filters import MessageFilter
@@ -17,6 +20,14 @@ import config
 import utils
 from bot.data import Profile, UserData
 from locales import language_map
+from nintendo.utils import ProfileQuarantinedError
+from utils import metrics, deadline
+
+logger = logging.getLogger('bot.utils')
+
+telegram_seconds = metrics.histogram('telegram_request_seconds', 'Latency of Telegram Bot API requests.', ('method',))
+telegram_responses = metrics.counter('telegram_responses_total', 'Responses of Telegram Bot API requests by status code.', ('method', 'status'))
+telegram_bytes = metrics.counter('telegram_received_bytes_total', 'Bytes received from the Telegram Bot API.', ('method',))
 
 
 class WhitelistFilter(MessageFilter):
@@ -53,7 +64,7 @@ class BackoffRetryRequest(HTTPXRequest):
             http_version=http_version
         )
 
-    @utils.retry_with_backoff(retries=sys.maxsize)
+    @utils.RetryPolicy(retries=config.get(config.BOT_REQUEST_RETRIES), deadline=config.get(config.BOT_REQUEST_DEADLINE))
     async def do_request(
             self,
             url: str,
@@ -64,7 +75,57 @@ class BackoffRetryRequest(HTTPXRequest):
             connect_timeout: ODVInput[float] = BaseRequest.DEFAULT_NONE,
             pool_timeout: ODVInput[float] = BaseRequest.DEFAULT_NONE,
     ) -> Tuple[int, bytes]:
-        return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        except Exception:
+            telegram_responses.inc(method=api_method, status='error')
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, method=api_method)
+        telegram_responses.inc(method=api_method, status=code)
+        telegram_bytes.inc(len(payload), method=api_method)
+        return code, payload
+
+
+def _is_timeout(e: Exception) -> bool:
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    # requests is only loaded by the first Nintendo request, and before that no error can come from it
+    import requests
+    return isinstance(e, requests.Timeout)
+
+
+def with_deadline(key: str):
+    """
+    run the handler under the deadline configured at `key`. the deadline caps every Nintendo request and retry
+    made by the handler, and the user gets a timeout reply instead of waiting for a stuck request.
+    a quarantined profile gets a reply as well, instead of no answer at all.
+    an expired token refresh started by the handler is not bound by this deadline, see `refresh_token`.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            seconds = config.get(key)
+            try:
+                with deadline.scope(seconds):
+                    return await asyncio.wait_for(fn(update, context), seconds)
+            except ProfileQuarantinedError as e:
+                logger.warning(f'Handler skipped a quarantined profile. handler = {fn.__name__}, error = {e}')
+                _ = translator(current_profile(context))
+                await update.effective_message.reply_text(text=_('Logging in to Nintendo failed repeatedly, so this profile is paused for a while. If the login was revoked, please add the profile again.'))
+            except Exception as e:
+                if not _is_timeout(e):
+                    raise
+                logger.warning(f'Handler timed out. handler = {fn.__name__}, deadline = {seconds}, error = {e!r}')
+                _ = translator(current_profile(context))
+                await update.effective_message.reply_text(text=_('The request timed out. Please try again later.'))
+
+        return wrapper
+
+    return decorator
 
 
 @dataclass
@@ -0,0 +1,147 @@
+import asyncio
+import hmac
+import collections
+import json
+import logging
+import signal
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+import config
+from utils.http import HTTPRequest, HTTPResponse, serve
+
+logger = logging.getLogger('bot.webhook')
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class UpdateDispatcher:
+    """
+    Processes updates of different users concurrently, up to `concurrency` at a time, and the updates of one user
+    in order, one at a time, so conversation states are not raced. Each user's updates queue up behind a worker
+    of their own, which only takes a concurrency slot when it is that update's turn, so a burst from one user
+    cannot hold the slots of everyone else.
+    """
+
+    def __init__(self, application: Application, concurrency: int):
+        self.application = application
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queues: dict[int, collections.deque] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    def _key(update: Update) -> Optional[int]:
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    def put(self, update: Update):
+        key = self._key(update)
+        if key is None:
+            task = asyncio.create_task(self._process(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+        self._queues.setdefault(key, collections.deque()).append(update)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key: int):
+        queue = self._queues[key]
+        try:
+            while len(queue) > 0:
+                await self._process(queue.popleft())
+        finally:
+            # nothing can be queued between the last check and here, so the next update starts a new worker
+            del self._queues[key]
+            del self._workers[key]
+
+    async def _process(self, update: Update):
+        async with self._semaphore:
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f'Failed to process update. update_id = {update.update_id}, error = {e}')
+
+    async def join(self):
+        """wait for the updates already received."""
+        await asyncio.gather(*self._workers.values(), *self._tasks, return_exceptions=True)
+
+
+class WebhookHandler:
+    """Validates webhook requests and hands the updates to the dispatcher."""
+
+    def __init__(self, application: Application, dispatcher: UpdateDispatcher, url_path: str, secret_token: str = None):
+        self.application = application
+        self.dispatcher = dispatcher
+        self.url_path = '/' + url_path.lstrip('/')
+        self.secret_token = secret_token
+
+    async def __call__(self, request: HTTPRequest) -> HTTPResponse:
+        if request.path.split('?')[0] != self.url_path:
+            return HTTPResponse(status=404)
+        if request.method != 'POST':
+            return HTTPResponse(status=405)
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            logger.warning(f'Rejected webhook request with invalid secret token.')
+            return HTTPResponse(status=403)
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f'Rejected malformed webhook request. error = {e}')
+            return HTTPResponse(status=400)
+        self.dispatcher.put(update)
+        return HTTPResponse()
+
+
+async def run_webhook(application: Application):
+    """
+    Serve updates through an embedded HTTP server instead of long polling.
+    Telegram is only told about the webhook if `bot.webhook.url` is set, so the server can be tested locally
+    by POSTing updates to `http://<listen>:<port>/<url_path>`.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # windows, rely on KeyboardInterrupt
+
+    listen = config.get(config.BOT_WEBHOOK_LISTEN)
+    port = config.get(config.BOT_WEBHOOK_PORT)
+    url_path = config.get(config.BOT_WEBHOOK_URL_PATH)
+    max_connections = config.get(config.BOT_WEBHOOK_MAX_CONNECTIONS)
+    url = config.get(config.BOT_WEBHOOK_URL)
+    secret_token = config.get(config.BOT_WEBHOOK_SECRET)
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        if url:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=secret_token,
+                max_connections=max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f'Set webhook. url = {url}')
+        dispatcher = UpdateDispatcher(application, config.get(config.BOT_WEBHOOK_CONCURRENT_UPDATES))
+        server = await serve(listen, port, WebhookHandler(application, dispatcher, url_path, secret_token), max_connections=max_connections)
+        await application.start()
+        logger.info(f'Serving webhook. listen = {listen}, port = {port}, url_path = {url_path}')
+        try:
+            await stop.wait()
+        finally:
+            server.close()  # idle keep-alive connections are dropped with the loop
+            await dispatcher.join()
+            await application.stop()
+            if application.post_stop is not None:
+                await application.post_stop(application)
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
@@ -1,2 +1,2 @@
 from config.consts import *
-from config.utils import load, get, set
+from config.utils import load, get, set, snapshot
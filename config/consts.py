@@ -4,21 +4,86 @@ BOT_TOKEN = 'bot.token'
 BOT_WHITELIST = 'bot.whitelist'
 BOT_ADMIN = 'bot.admin'
 BOT_STORAGE_CHANNEL = 'bot.storage_channel'
+BOT_OUTBOX_WINDOW = 'bot.outbox_window_in_seconds'
+BOT_REQUEST_RETRIES = 'bot.request_retries'
+BOT_REQUEST_DEADLINE = 'bot.request_deadline_in_seconds'
+BOT_RATE_LIMIT_RETRIES = 'bot.rate_limit_retries'
+
+BOT_WEBHOOK_ENABLED = 'bot.webhook.enabled'
+BOT_WEBHOOK_URL = 'bot.webhook.url'
+BOT_WEBHOOK_SECRET = 'bot.webhook.secret_token'
+BOT_WEBHOOK_LISTEN = 'bot.webhook.listen'
+BOT_WEBHOOK_PORT = 'bot.webhook.port'
+BOT_WEBHOOK_URL_PATH = 'bot.webhook.url_path'
+BOT_WEBHOOK_MAX_CONNECTIONS = 'bot.webhook.max_connections'
+BOT_WEBHOOK_CONCURRENT_UPDATES = 'bot.webhook.concurrent_updates'
 
 APP_MAX_PROFILE = 'app.max_profile'
 
+METRICS_ENABLED = 'metrics.enabled'
+METRICS_LISTEN = 'metrics.listen'
+METRICS_PORT = 'metrics.port'
+
+TRACING_CAPACITY = 'tracing.capacity'
+TRACING_EXPORT_PATH = 'tracing.export_path'
+
+WATCHDOG_ENABLED = 'watchdog.enabled'
+WATCHDOG_THRESHOLD = 'watchdog.threshold_in_seconds'
+WATCHDOG_INTERVAL = 'watchdog.interval_in_seconds'
+
+DEADLINE_COMMAND = 'deadline.command_in_seconds'
+DEADLINE_LOGIN = 'deadline.login_in_seconds'
+DEADLINE_MONITOR = 'deadline.monitor_in_seconds'
+DEADLINE_JOB = 'deadline.job_in_seconds'
+
+OVERLOAD_LAG_THRESHOLDS = 'overload.lag_thresholds_in_seconds'
+OVERLOAD_DEPTH_THRESHOLDS = 'overload.outbox_depth_thresholds'
+OVERLOAD_MONITOR_STRETCH = 'overload.monitor_stretch'
+OVERLOAD_MAX_DEFER = 'overload.max_defer_in_seconds'
+
+CLUSTER_ROLE = 'cluster.role'
+CLUSTER_WORKER_ID = 'cluster.worker_id'
+CLUSTER_PATH = 'cluster.path'
+CLUSTER_VIRTUAL_NODES = 'cluster.virtual_nodes'
+CLUSTER_SYNC_INTERVAL = 'cluster.sync_interval_in_seconds'
+CLUSTER_MEMBER_TTL = 'cluster.member_ttl_in_seconds'
+
+LEASE_BACKEND = 'lease.backend'
+LEASE_PATH = 'lease.path'
+LEASE_REDIS_URL = 'lease.redis_url'
+LEASE_TTL = 'lease.ttl_in_seconds'
+
 NINTENDO_APP_VERSION = 'nintendo.app_version'
 NINTENDO_S3S_VERSION = 'nintendo.s3s_version'
 NINTENDO_WEBVIEW_VERSION = 'nintendo.webview_version'
 NINTENDO_GRAPHQL_REQUEST_MAP = 'nintendo.graphql_query_map'
+NINTENDO_VERSIONS_PATH = 'nintendo.versions_path'
 
 NINTENDO_VERSION_UPDATE_INTERVAL = 'nintendo.version_update_interval_in_seconds'
 NINTENDO_TOKEN_UPDATE_INTERVAL = 'nintendo.token_update_interval_in_seconds'
+NINTENDO_KEEP_ALIVE_SLOTS = 'nintendo.keep_alive_slots'
+NINTENDO_KEEP_ALIVE_CONCURRENCY = 'nintendo.keep_alive_concurrency'
+NINTENDO_QUARANTINE_THRESHOLD = 'nintendo.quarantine.threshold'
+NINTENDO_QUARANTINE_BASE = 'nintendo.quarantine.base_in_seconds'
+NINTENDO_QUARANTINE_MAX = 'nintendo.quarantine.max_in_seconds'
 NINTENDO_MONITOR_INTERVAL = 'nintendo.monitor_interval_in_seconds'
 NINTENDO_MONITOR_FREEZE_TIME = 'nintendo.monitor_freeze_time_in_seconds'
 NINTENDO_AUTO_STOP = 'nintendo.monitor_auto_stop_in_minutes'
 NINTENDO_RETRIEVE_PREVIOUS = 'nintendo.retrieve_previous_in_minutes'
 
+NINTENDO_REQUEST_TIMEOUT = 'nintendo.request_timeout_in_seconds'
+
+NINTENDO_HEDGE_ENABLED = 'nintendo.hedge.enabled'
+NINTENDO_HEDGE_QUANTILE = 'nintendo.hedge.quantile'
+NINTENDO_HEDGE_MAX_RATIO = 'nintendo.hedge.max_ratio'
+
+NINTENDO_ASSET_CACHE_PATH = 'nintendo.asset_cache.path'
+NINTENDO_ASSET_CACHE_MAX_SIZE = 'nintendo.asset_cache.max_size_in_mb'
+NINTENDO_ASSET_CACHE_TTL = 'nintendo.asset_cache.ttl_in_seconds'
+
 NINTENDO_PROXY_ENABLED = 'nintendo.proxy.enabled'
 NINTENDO_PROXY_HTTP = 'nintendo.proxy.http'
 NINTENDO_PROXY_HTTPS = 'nintendo.proxy.https'
+NINTENDO_PROXY_URLS = 'nintendo.proxy.urls'
+NINTENDO_PROXY_CHECK_URL = 'nintendo.proxy.check_url'
+NINTENDO_PROXY_CHECK_INTERVAL = 'nintendo.proxy.check_interval_in_seconds'
@@ -1,42 +1,125 @@
+import copy
 import json
-import typing
-from typing import List
+import types
+from typing import AbstractSet, Any, Iterator, List, Mapping
 
-import jsonpath_ng
-
-config = None
 overwrite_map = {}
 
 
+class Section(Mapping[str, Any]):
+    """
+    A read-only node of the config snapshot. Keys are attributes too, e.g. `config.snapshot().nintendo.proxy.enabled`.
+    Values keep the type they have in the config file, except that nested objects are sections, and lists and sets
+    are tuples and frozensets, so nothing reachable from the snapshot can be changed in place.
+    """
+
+    def __init__(self, values: dict[str, Any]):
+        # the values live in the instance dict, so attribute access is a plain lookup
+        self.__dict__.update(values)
+
+    def __setattr__(self, name: str, value):
+        raise AttributeError('config snapshot is read-only, use config.set')
+
+    def __delattr__(self, name: str):
+        raise AttributeError('config snapshot is read-only, use config.set')
+
+    def __getitem__(self, key: str):
+        return self.__dict__[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__dict__)
+
+    def __len__(self) -> int:
+        return len(self.__dict__)
+
+    def __repr__(self) -> str:
+        return f'Section({self.__dict__!r})'
+
+
+_tree: dict = {}
+# the tree and its flat index, swapped together
+_compiled: tuple[Section, Mapping[str, Any]] = (Section({}), types.MappingProxyType({}))
+
+
 def load(path: str, args_overwrite: List[str] = None):
-    global config
+    """
+    Compile the config file into a frozen snapshot: a tree of sections with attribute access, and a flat index
+    keyed by dotted path, e.g. `nintendo.proxy.enabled`, for `get`. Overwrites are applied up front, and the new
+    snapshot replaces the old one in a single assignment, so loading again is atomic for readers.
+    """
+    global _tree
     with open(path, "r") as f:
-        config = json.load(f)
+        tree = json.load(f)
     if args_overwrite is not None:
+        values = __flatten(tree)
         for i in args_overwrite:
-            __parse_overwrite(i)
+            key, value = i.split('=', 1)
+            overwrite_map[key] = __convert(values.get(key), value)
+    _tree = tree
+    __compile()
 
 
 def get(key: str):
-    global overwrite_map
-    if key in overwrite_map:
-        return overwrite_map[key]
-    exp = jsonpath_ng.parse(key)
-    ret = [match.value for match in exp.find(config)]
-    return ret[0] if len(ret) == 1 else ret
+    # an unknown key gives an empty list, like the empty match of the former jsonpath lookup
+    return _compiled[1].get(key, [])
 
 
 def set(key: str, value):
     overwrite_map[key] = value
+    __compile()
+
+
+def snapshot() -> Section:
+    return _compiled[0]
+
+
+def __compile():
+    global _compiled
+    tree = copy.deepcopy(_tree)
+    for key, value in overwrite_map.items():
+        *parents, name = key.split('.')
+        node = tree
+        for parent in parents:
+            if not isinstance(node.get(parent), dict):
+                node[parent] = {}
+            node = node[parent]
+        node[name] = value
+    root = __freeze(tree)
+    _compiled = (root, types.MappingProxyType(__flatten(root)))
+
 
+def __freeze(value):
+    if isinstance(value, Mapping):
+        return Section({k: __freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(__freeze(v) for v in value)
+    if isinstance(value, AbstractSet):
+        return frozenset(value)
+    return value
 
-def __parse_overwrite(line: str):
-    global overwrite_map
-    key, value = line.split('=')
-    old = get(key)
-    t = type(old)
+
+def __flatten(node, prefix: str = '') -> dict[str, Any]:
+    values = {}
+    if prefix != '':
+        values[prefix] = node
+    if isinstance(node, Mapping):
+        for k, v in node.items():
+            values.update(__flatten(v, f'{prefix}.{k}' if prefix != '' else k))
+    return values
+
+
+def __convert(old, value: str):
     if isinstance(old, List):
-        new = [typing.cast(t, i) for i in value.split(',')]
-    else:
-        new = typing.cast(t, value)
-    overwrite_map[key] = new
+        t = type(old[0]) if len(old) > 0 else str
+        return [__convert_scalar(t, i) for i in value.split(',')]
+    if old is None:
+        return value
+    return __convert_scalar(type(old), value)
+
+
+def __convert_scalar(t: type, value: str):
+    if t is bool:
+        return value.lower() in ('true', '1', 'yes', 'on')
+    if t in (int, float, str):
+        return t(value)
+    return value
@@ -1,7 +1,10 @@
 import argparse
 import logging
+import os
+import socket
 
 import config
+from utils import startup
 
 # init argparse
 parser = argparse.ArgumentParser(description='run splatoon3 bot')
@@ -11,14 +14,30 @@ parser.add_argument('-u', '--user', type=str, action='append', default=[], metav
 parser.add_argument('-U', '--admin', type=str, action='append', default=[], metavar='<username>', help='admin users. They will be treated as whitelisted users too.')
 parser.add_argument('--overwrite', type=str, action='append', metavar='<config_key>=<value>', help='overwrite config.')
 parser.add_argument('-s', '--storage_channel', type=str, required=True, metavar='<channel_id>', help='a channel that saves images.')
+parser.add_argument('--webhook', action='store_true', help='receive updates through the embedded webhook server instead of polling.')
+parser.add_argument('--webhook_url', type=str, metavar='<url>', help='public url registered to telegram in webhook mode. skip it to only serve locally.')
+parser.add_argument('--webhook_secret', type=str, metavar='<secret_token>', help='secret token that webhook requests must carry.')
+parser.add_argument('--role', type=str, choices=['standalone', 'frontend', 'worker'], default='standalone', help='standalone runs everything. a frontend handles telegram updates, and workers run the monitors and keep-alive of their share of users.')
+parser.add_argument('--worker_id', type=str, metavar='<worker_id>', help='stable id of a worker on the hash ring and holder of its leases. defaults to <hostname> for standalone, and <hostname>-<pid> otherwise.')
+parser.add_argument('--profile_startup', action='store_true', help='log per-module import time and time to first update.')
 args = parser.parse_args()
 
+if args.profile_startup:
+    startup.profiler.install()
+
 # init config
 config.load(args.config, args_overwrite=args.overwrite)
 config.set(config.BOT_TOKEN, args.token)
 config.set(config.BOT_ADMIN, set(args.admin))
 config.set(config.BOT_WHITELIST, set(args.user + args.admin))
 config.set(config.BOT_STORAGE_CHANNEL, args.storage_channel)
+config.set(config.BOT_WEBHOOK_ENABLED, args.webhook)
+config.set(config.BOT_WEBHOOK_URL, args.webhook_url)
+config.set(config.BOT_WEBHOOK_SECRET, args.webhook_secret)
+config.set(config.CLUSTER_ROLE, args.role)
+# a standalone replica keeps its id across restarts, so it gets its own leases back instead of waiting them out.
+# processes of a cluster may share a host, so they need their pid as well unless given an id
+config.set(config.CLUSTER_WORKER_ID, args.worker_id or (socket.gethostname() if args.role == 'standalone' else f'{socket.gethostname()}-{os.getpid()}'))
 
 # init logging
 logging.basicConfig(
@@ -29,5 +48,9 @@ logging.basicConfig(
 if __name__ == '__main__':
     import bot
 
+    if args.profile_startup:
+        startup.profiler.uninstall()
+        startup.profiler.report()
+
     # run bot
     bot.run()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger('nintendo.assets')
+
+
+class AssetCache:
+    """Disk-backed HTTP cache for image assets, keyed by URL without its query string,
+    which carries parameters that change while the image stays the same.
+
+    Each entry is a pair of files: `<hash>.bin` for the body and `<hash>.json` for the validators.
+    Fresh entries are served without any request, stale ones are revalidated by a conditional GET.
+    Freshness follows the server's Cache-Control max-age or Expires, `ttl` only applies when it sends neither.
+    Least recently used entries are evicted once the total size exceeds `max_size`.
+    """
+
+    def __init__(self, path: str, max_size: int, ttl: int):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        # running total of the bodies, so a miss does not list the directory. resynced by every eviction
+        self._size = sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.bin'))
+
+    def get(self, url: str, headers: dict[str, str] = None, **kwargs) -> bytes:
+        """fetch url through the cache. Blocking, so call it in an executor."""
+        key = hashlib.sha1(url.split('?')[0].encode('utf-8')).hexdigest()
+        meta = self._load_meta(key)
+        body = self._load_body(key) if meta is not None else None
+        if body is not None and meta['expires'] > time.time():
+            return body
+
+        headers = dict(headers or {})
+        if body is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        import requests
+        response = requests.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and body is not None:
+            meta['expires'] = self._expires(response)
+            self._save_meta(key, meta)
+            return body
+        response.raise_for_status()
+
+        body = response.content
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires': self._expires(response),
+        }
+        self._save(key, meta, body)
+        self._evict()
+        return body
+
+    def _expires(self, response: 'requests.Response') -> float:
+        cache_control = response.headers.get('Cache-Control', '')
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        if match is not None:
+            return time.time() + int(match.group(1))
+        expires = response.headers.get('Expires')
+        if expires is not None:
+            try:
+                return parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                # an invalid date means already expired
+                return 0
+        return time.time() + self.ttl
+
+    def _file(self, key: str, ext: str) -> str:
+        return os.path.join(self.path, f'{key}.{ext}')
+
+    def _load_meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._file(key, 'json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_body(self, key: str) -> Optional[bytes]:
+        file = self._file(key, 'bin')
+        try:
+            with open(file, 'rb') as f:
+                body = f.read()
+            # mtime tracks the last access for eviction
+            os.utime(file)
+            return body
+        except OSError:
+            return None
+
+    def _save_meta(self, key: str, meta: dict):
+        with self._lock:
+            self._write(self._file(key, 'json'), json.dumps(meta).encode('utf-8'))
+
+    def _save(self, key: str, meta: dict, body: bytes):
+        with self._lock:
+            try:
+                self._size -= os.stat(self._file(key, 'bin')).st_size
+            except OSError:
+                pass
+            self._write(self._file(key, 'bin'), body)
+            self._size += len(body)
+            self._write(self._file(key, 'json'), json.dumps(meta).encode('utf-8'))
+
+    @staticmethod
+    def _write(file: str, data: bytes):
+        tmp = f'{file}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, file)
+
+    def _evict(self):
+        with self._lock:
+            if self._size <= self.max_size:
+                return
+            entries = []
+            total = 0
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith('.bin'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.name[:-len('.bin')]))
+                total += stat.st_size
+            self._size = total
+            if total <= self.max_size:
+                return
+            entries.sort()
+            evicted = 0
+            for _, size, key in entries:
+                if total <= self.max_size:
+                    break
+                for ext in ('bin', 'json'):
+                    try:
+                        os.remove(self._file(key, ext))
+                    except OSError:
+                        pass
+                total -= size
+                evicted += 1
+            self._size = total
+            logger.info(f'Evicted cached assets. number = {evicted}, size = {total}')
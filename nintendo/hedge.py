@@ -0,0 +1,75 @@
+import asyncio
+import collections
+import logging
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from utils import metrics
+
+logger = logging.getLogger('nintendo.hedge')
+
+hedges = metrics.counter('nintendo_hedged_requests_total', 'Hedged requests by the attempt that answered first.', ('query', 'winner'))
+
+T = TypeVar('T')
+
+
+class Hedger:
+    """
+    Request hedging for idempotent requests. If an attempt has not answered after the observed `quantile` latency
+    of its key, a second attempt is started and whichever answers first wins. Hedges are capped to `max_ratio`
+    of the last `window` requests, so they add a few percent of load at most.
+    """
+
+    def __init__(self, quantile: float, max_ratio: float, window: int = 1000, min_samples: int = 20):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: dict[str, collections.deque[float]] = {}
+        self._history: collections.deque[bool] = collections.deque(maxlen=window)
+        self._hedged = 0
+
+    def observe(self, key: str, seconds: float):
+        self._samples.setdefault(key, collections.deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, key: str) -> Optional[float]:
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.quantile), len(ordered) - 1)]
+
+    def _record(self, hedged: bool):
+        if len(self._history) == self._history.maxlen and self._history[0]:
+            self._hedged -= 1
+        self._history.append(hedged)
+        self._hedged += hedged
+
+    def _allowed(self) -> bool:
+        return self._hedged < self.max_ratio * max(len(self._history), 1)
+
+    async def run(self, key: str, attempt: Callable[[], Awaitable[T]]) -> T:
+        delay = self.delay(key)
+        primary = asyncio.ensure_future(attempt())
+        if delay is None:
+            self._record(False)
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if len(done) > 0 or not self._allowed():
+            self._record(False)
+            return await primary
+
+        self._record(True)
+        hedge = asyncio.ensure_future(attempt())
+        pending = {primary, hedge}
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: t.exception() is not None):
+                    # fall back to the other attempt if this one failed
+                    if task.exception() is None or len(pending) == 0:
+                        hedges.inc(query=key, winner='primary' if task is primary else 'hedge')
+                        return task.result()
+        finally:
+            for task in pending:
+                # the blocking request keeps its executor thread until it finishes, only its result is dropped
+                task.cancel()
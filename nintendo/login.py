@@ -2,18 +2,24 @@ import asyncio
 import base64
 import functools
 import hashlib
+import http.cookiejar
 import json
 import logging
 import os
 import re
+import time
 import urllib.parse
-
-import requests
-from bs4 import BeautifulSoup
+from typing import Optional, TYPE_CHECKING
 
 import config
 import utils.retry
-from nintendo.utils import NintendoError
+from nintendo.proxy import proxy_pool
+from nintendo.utils import NintendoError, RequestRejectedError
+from nintendo.versions import registry
+from utils import metrics, deadline
+
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger('nintendo')
 
@@ -22,37 +28,92 @@ APP_USER_AGENT = 'Mozilla/5.0 (Linux; Android 11; Pixel 5) ' \
                  'AppleWebKit/537.36 (KHTML, like Gecko) ' \
                  'Chrome/94.0.4606.61 Mobile Safari/537.36'
 
-NSOAPP_VERSION = config.get(config.NINTENDO_APP_VERSION)
-S3S_VERSION = config.get(config.NINTENDO_S3S_VERSION)
-WEBVIEW_VERSION = config.get(config.NINTENDO_WEBVIEW_VERSION)
-
-
-@utils.retry_with_backoff()
+# one keep-alive session for every login step, so the steps reuse connections to the same hosts.
+# it must not keep cookies, since it is shared by all users. created by the first login step, so importing the bot
+# does not load requests.
+_session: Optional['requests.Session'] = None
+
+login_seconds = metrics.histogram('nintendo_login_seconds', 'Latency of each login and version lookup step.', ('step',))
+login_responses = metrics.counter('nintendo_login_responses_total', 'Responses of each login and version lookup step by status code.', ('step', 'status'))
+login_bytes = metrics.counter('nintendo_login_received_bytes_total', 'Bytes received by each login and version lookup step.', ('step',))
+
+
+def session() -> 'requests.Session':
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        _session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+    return _session
+
+
+async def _send(step: str, fn, handled: tuple[int, ...] = ()) -> 'requests.Response':
+    """
+    run a blocking request in the executor through the proxy of the current profile and record its metrics. the timeout
+    is capped by the current deadline. a 4xx reply raises RequestRejectedError, unless its status is in `handled`.
+    """
+    proxy = proxy_pool.select()
+    fn = functools.partial(fn, proxies=proxy.proxies if proxy else {}, timeout=deadline.timeout(config.get(config.NINTENDO_REQUEST_TIMEOUT)))
+    start = time.perf_counter()
+    try:
+        r: 'requests.Response' = await asyncio.get_event_loop().run_in_executor(None, fn)
+    except Exception as e:
+        proxy_pool.observe(proxy, time.perf_counter() - start, e)
+        login_responses.inc(step=step, status='error')
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        login_seconds.observe(seconds, step=step)
+        logger.debug(f'Finished login step. step = {step}, seconds = {seconds:.3f}')
+    proxy_pool.observe(proxy, seconds)
+    login_responses.inc(step=step, status=r.status_code)
+    login_bytes.inc(len(r.content), step=step)
+    if r.status_code in (408, 429) or r.status_code >= 500:
+        # let the retry policy back off, instead of failing to parse an error page
+        r.raise_for_status()
+    if 400 <= r.status_code < 500 and r.status_code not in handled:
+        raise RequestRejectedError(f'Nintendo rejected the request. step = {step}, status = {r.status_code}, response = {r.text}')
+    return r
+
+
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def update_nsoapp_version() -> str:
     """Fetches the current Nintendo Switch Online app version from the Apple App Store and sets it globally."""
-    global NSOAPP_VERSION
-    page = await asyncio.get_event_loop().run_in_executor(None, requests.get, "https://apps.apple.com/us/app/nintendo-switch-online/id1234806557")
+    url = "https://apps.apple.com/us/app/nintendo-switch-online/id1234806557"
+    fn = functools.partial(session().get, url, headers=registry.conditional_headers('app_store'))
+    page = await _send('app_store', fn)
+    if page.status_code == 304:
+        return registry.nsoapp_version
+
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(page.text, 'html.parser')
     elt = soup.find("p", {"class": "whats-new__latest__version"})
     version = elt.get_text().replace("Version ", "").strip()
-    NSOAPP_VERSION = version
-    return NSOAPP_VERSION
+    registry.nsoapp_version = version
+    registry.remember('app_store', page)
+    return registry.nsoapp_version
 
 
-@utils.retry_with_backoff()
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def update_s3s_version() -> str:
     """Fetch s3s version from GitHub"""
-    global S3S_VERSION
-    latest_script = await asyncio.get_event_loop().run_in_executor(None, requests.get, "https://raw.githubusercontent.com/frozenpandaman/s3s/master/s3s.py")
+    url = "https://raw.githubusercontent.com/frozenpandaman/s3s/master/s3s.py"
+    fn = functools.partial(session().get, url, headers=registry.conditional_headers('s3s'))
+    latest_script = await _send('s3s', fn)
+    if latest_script.status_code == 304:
+        return registry.s3s_version
     version = re.search(r'A_VERSION = "([\d.]*)"', latest_script.text).group(1)
-    S3S_VERSION = version
-    return S3S_VERSION
+    registry.s3s_version = version
+    registry.remember('s3s', latest_script)
+    return registry.s3s_version
 
 
-@utils.retry_with_backoff()
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def update_webview_version() -> str:
     """Finds & parses the SplatNet 3 main.js file to fetch the current site version and sets it globally."""
-    global WEBVIEW_VERSION
     url = 'https://api.lp1.av5ja.srv.nintendo.net'
     app_head = {
         'Upgrade-Insecure-Requests': '1',
@@ -63,16 +124,21 @@ async def update_webview_version() -> str:
         'Sec-Fetch-Site': 'none',
         'Sec-Fetch-Mode': 'navigate',
         'Sec-Fetch-User': '?1',
-        'Sec-Fetch-Dest': 'document'
+        'Sec-Fetch-Dest': 'document',
+        **registry.conditional_headers('webview_home'),
     }
     app_cookies = {
         '_dnt': '1'  # Do Not Track
     }
-    fn = functools.partial(requests.get, url, headers=app_head, cookies=app_cookies)
-    home = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().get, url, headers=app_head, cookies=app_cookies)
+    home = await _send('webview_home', fn)
+    if home.status_code == 304:  # same page, so the same main.js
+        return registry.webview_version
     if home.status_code != 200:
         raise NintendoError('home response status_code was not 200 ')
 
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(home.text, 'html.parser')
     main_js = soup.select_one("script[src*='static']")
 
@@ -90,8 +156,8 @@ async def update_webview_version() -> str:
         'Referer': url  # sending w/o lang, na_country, na_lang params
     }
 
-    fn = functools.partial(requests.get, main_js_url, headers=app_head, cookies=app_cookies)
-    main_js_body = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().get, main_js_url, headers=app_head, cookies=app_cookies)
+    main_js_body = await _send('webview_main_js', fn)
     if main_js_body.status_code != 200:
         raise NintendoError('main_js_body response status_code was not 200 ')
 
@@ -102,8 +168,9 @@ async def update_webview_version() -> str:
 
     version, revision = match.group('version'), match.group('revision')
     ver_string = f'{version}-{revision[:8]}'
-    WEBVIEW_VERSION = ver_string
-    return WEBVIEW_VERSION
+    registry.webview_version = ver_string
+    registry.remember('webview_home', home)
+    return registry.webview_version
 
 
 def login_link():
@@ -132,7 +199,7 @@ async def get_session_token(auth_code_verifier: bytes, link: str):
     session_token_code = re.search('de=(.*)&', link).group(1)
 
     app_head = {
-        'User-Agent': f'OnlineLounge/{NSOAPP_VERSION} NASDKAPI Android',
+        'User-Agent': f'OnlineLounge/{registry.nsoapp_version} NASDKAPI Android',
         'Accept-Language': 'en-US',
         'Accept': 'application/json',
         'Content-Type': 'application/x-www-form-urlencoded',
@@ -150,19 +217,18 @@ async def get_session_token(auth_code_verifier: bytes, link: str):
 
     url = 'https://accounts.nintendo.com/connect/1.0.0/api/session_token'
 
-    session = requests.Session()
-
-    fn = functools.partial(session.post, url, headers=app_head, data=body)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().post, url, headers=app_head, data=body)
+    r = await _send('session_token', fn)
     try:
         return json.loads(r.text)["session_token"]
     except:
         raise NintendoError(f'Failed to get session token. response = {r.text}')
 
 
-@utils.retry_with_backoff()
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def get_gtoken(session_token):
     """Provided the session_token, returns a GameWebToken JWT and account info."""
+    start = time.perf_counter()
     app_head = {
         'Host': 'accounts.nintendo.com',
         'Accept-Encoding': 'gzip',
@@ -180,8 +246,8 @@ async def get_gtoken(session_token):
     }
 
     url = 'https://accounts.nintendo.com/connect/1.0.0/api/token'
-    fn = functools.partial(requests.post, url, headers=app_head, json=body)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().post, url, headers=app_head, json=body)
+    r = await _send('token', fn)
     id_response = json.loads(r.text)
 
     if 'access_token' not in id_response:
@@ -202,8 +268,12 @@ async def get_gtoken(session_token):
         raise NintendoError(f'Not a valid authorization request. Please delete config.txt and try again. Error from Nintendo (in api/token step): {json.dumps(id_response, indent=2)}')
 
     url = 'https://api.accounts.nintendo.com/2.0.0/users/me'
-    fn = functools.partial(requests.get, url, headers=app_head)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().get, url, headers=app_head)
+    # the step 1 f token only needs the id token, so it is fetched while users/me is in flight
+    id_token = id_response.get("id_token")
+    r, f_result = await asyncio.gather(_send('users_me', fn), call_f_api(id_token, 1), return_exceptions=True)
+    if isinstance(r, BaseException):
+        raise r
     user_info = json.loads(r.text)
     logger.info(f'Nintendo user_info = {user_info}')
 
@@ -214,8 +284,9 @@ async def get_gtoken(session_token):
     # get access token
     body = {}
     try:
-        id_token = id_response["id_token"]
-        f, uuid, timestamp = await call_f_api(id_token, 1)
+        if isinstance(f_result, BaseException):
+            raise f_result
+        f, uuid, timestamp = f_result
 
         parameter = {
             'f': f,
@@ -233,17 +304,17 @@ async def get_gtoken(session_token):
 
     app_head = {
         'X-Platform': 'Android',
-        'X-ProductVersion': NSOAPP_VERSION,
+        'X-ProductVersion': registry.nsoapp_version,
         'Content-Type': 'application/json; charset=utf-8',
         'Content-Length': str(990 + len(f)),
         'Connection': 'Keep-Alive',
         'Accept-Encoding': 'gzip',
-        'User-Agent': f'com.nintendo.znca/{NSOAPP_VERSION}(Android/7.1.2)',
+        'User-Agent': f'com.nintendo.znca/{registry.nsoapp_version}(Android/7.1.2)',
     }
 
     url = 'https://api-lp1.znc.srv.nintendo.net/v3/Account/Login'
-    fn = functools.partial(requests.post, url, headers=app_head, json=body)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().post, url, headers=app_head, json=body)
+    r = await _send('account_login', fn)
     splatoon_token = json.loads(r.text)
 
     try:
@@ -257,24 +328,25 @@ async def get_gtoken(session_token):
             body["parameter"]["timestamp"] = timestamp
             app_head["Content-Length"] = str(990 + len(f))
             url = "https://api-lp1.znc.srv.nintendo.net/v3/Account/Login"
-            fn = functools.partial(requests.post, url, headers=app_head, json=body)
-            r = await asyncio.get_event_loop().run_in_executor(None, fn)
+            fn = functools.partial(session().post, url, headers=app_head, json=body)
+            r = await _send('account_login', fn)
             splatoon_token = json.loads(r.text)
             id_token = splatoon_token["result"]["webApiServerCredential"]["accessToken"]
         except:
             raise NintendoError(f'Error from Nintendo (in Account/Login step): {json.dumps(splatoon_token, indent=2)}')
 
-        f, uuid, timestamp = await call_f_api(id_token, 2)
+    # the step 2 f token is needed on the first attempt too, not only after a failed Account/Login
+    f, uuid, timestamp = await call_f_api(id_token, 2)
 
     # get web service token
     app_head = {
         'X-Platform': 'Android',
-        'X-ProductVersion': NSOAPP_VERSION,
+        'X-ProductVersion': registry.nsoapp_version,
         'Authorization': f'Bearer {id_token}',
         'Content-Type': 'application/json; charset=utf-8',
         'Content-Length': '391',
         'Accept-Encoding': 'gzip',
-        'User-Agent': f'com.nintendo.znca/{NSOAPP_VERSION}(Android/7.1.2)'
+        'User-Agent': f'com.nintendo.znca/{registry.nsoapp_version}(Android/7.1.2)'
     }
 
     body = {}
@@ -288,8 +360,8 @@ async def get_gtoken(session_token):
     body["parameter"] = parameter
 
     url = "https://api-lp1.znc.srv.nintendo.net/v2/Game/GetWebServiceToken"
-    fn = functools.partial(requests.post, url, headers=app_head, json=body)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().post, url, headers=app_head, json=body)
+    r = await _send('web_service_token', fn)
     web_service_resp = json.loads(r.text)
 
     try:
@@ -302,38 +374,41 @@ async def get_gtoken(session_token):
             body["parameter"]["requestId"] = uuid
             body["parameter"]["timestamp"] = timestamp
             url = "https://api-lp1.znc.srv.nintendo.net/v2/Game/GetWebServiceToken"
-            fn = functools.partial(requests.post, url, headers=app_head, json=body)
-            r = await asyncio.get_event_loop().run_in_executor(None, fn)
+            fn = functools.partial(session().post, url, headers=app_head, json=body)
+            r = await _send('web_service_token', fn)
             web_service_resp = json.loads(r.text)
             web_service_token = web_service_resp["result"]["accessToken"]
         except:
             raise NintendoError(f'Error from Nintendo (in Game/GetWebServiceToken step): {json.dumps(web_service_resp, indent=2)}')
 
+    logger.info(f'Got web service token. seconds = {time.perf_counter() - start:.3f}')
     return web_service_token, user_nickname, user_lang, user_country
 
 
-@utils.retry_with_backoff()
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def call_f_api(id_token, step):
     """Passes an naIdToken to the f generation API (default: imink) & fetches the response (f token, UUID, and timestamp)."""
     f_gen_url = 'https://api.imink.app/f'
 
     try:
         api_head = {
-            'User-Agent': f's3s/{S3S_VERSION}',
+            'User-Agent': f's3s/{registry.s3s_version}',
             'Content-Type': 'application/json; charset=utf-8'
         }
         api_body = {
             'token': id_token,
             'hash_method': step
         }
-        fn = functools.partial(requests.post, f_gen_url, data=json.dumps(api_body), headers=api_head)
-        api_response = await asyncio.get_event_loop().run_in_executor(None, fn)
+        fn = functools.partial(session().post, f_gen_url, data=json.dumps(api_body), headers=api_head)
+        api_response = await _send(f'f_{step}', fn)
         resp = json.loads(api_response.text)
 
         f = resp["f"]
         uuid = resp["request_id"]
         timestamp = resp["timestamp"]
         return f, uuid, timestamp
+    except RequestRejectedError:
+        raise
     except:
         try:  # if api_response never gets set
             if api_response.text:
@@ -344,7 +419,7 @@ async def call_f_api(id_token, step):
             raise NintendoError(f"Couldn't connect to f generation API ({f_gen_url}). Please try again.")
 
 
-@utils.retry_with_backoff()
+@utils.RetryPolicy(fatal=(RequestRejectedError,))
 async def get_bullet(web_service_token, user_lang, user_country):
     """Given a gtoken, returns a bulletToken."""
     splatnet3_url = 'https://api.lp1.av5ja.srv.nintendo.net'
@@ -354,7 +429,7 @@ async def get_bullet(web_service_token, user_lang, user_country):
         'Content-Type': 'application/json',
         'Accept-Language': user_lang,
         'User-Agent': APP_USER_AGENT,
-        'X-Web-View-Ver': WEBVIEW_VERSION,
+        'X-Web-View-Ver': registry.webview_version,
         'X-NACOUNTRY': user_country,
         'Accept': '*/*',
         'Origin': splatnet3_url,
@@ -365,15 +440,15 @@ async def get_bullet(web_service_token, user_lang, user_country):
         '_dnt': '1'  # Do Not Track
     }
     url = f'{splatnet3_url}/api/bullet_tokens'
-    fn = functools.partial(requests.post, url, headers=app_head, cookies=app_cookies)
-    r = await asyncio.get_event_loop().run_in_executor(None, fn)
+    fn = functools.partial(session().post, url, headers=app_head, cookies=app_cookies)
+    r = await _send('bullet_token', fn, handled=(401, 403))
 
     if r.status_code == 401:
-        raise NintendoError('Unauthorized error (ERROR_INVALID_GAME_WEB_TOKEN). Cannot fetch tokens at this time.')
+        raise RequestRejectedError('Unauthorized error (ERROR_INVALID_GAME_WEB_TOKEN). Cannot fetch tokens at this time.')
     elif r.status_code == 403:
-        raise NintendoError('Forbidden error (ERROR_OBSOLETE_VERSION). Cannot fetch tokens at this time.')
+        raise RequestRejectedError('Forbidden error (ERROR_OBSOLETE_VERSION). Cannot fetch tokens at this time.')
     elif r.status_code == 204:  # No Content, USER_NOT_REGISTERED
-        raise NintendoError('Cannot access SplatNet 3 without having played online.')
+        raise RequestRejectedError('Cannot access SplatNet 3 without having played online.')
 
     try:
         bullet_resp = json.loads(r.text)
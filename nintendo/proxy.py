@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import time
+import urllib.parse
+from dataclasses import dataclass
+from typing import Optional
+
+import config
+from utils import metrics
+
+logger = logging.getLogger('nintendo.proxy')
+
+proxy_requests = metrics.counter('nintendo_proxy_requests_total', 'Requests sent through each proxy by result.', ('proxy', 'result'))
+proxy_healthy = metrics.gauge('nintendo_proxy_healthy', 'Whether a proxy passed its last health check.', ('proxy',))
+proxy_pinned = metrics.gauge('nintendo_proxy_pinned_profiles', 'Profiles pinned to each proxy.', ('proxy',))
+
+# the profile whose requests are being sent, set by the bot around each call for a profile
+current_profile: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('proxy_profile', default=None)
+
+
+@dataclass
+class Proxy:
+    name: str
+    proxies: dict[str, str]
+    healthy: bool = True
+    latency: float = 1.0
+    failures: int = 0
+    pinned: int = 0
+
+    @property
+    def load(self) -> float:
+        """expected latency of the profiles pinned to it, lower is better."""
+        return (self.pinned + 1) * self.latency
+
+
+class ProxyPool:
+    """
+    Spreads Nintendo traffic over several egress proxies.
+    Each profile is pinned to one proxy, so an account keeps talking from the same IP; new profiles go to the proxy
+    with the lowest load (pinned profiles weighted by latency). A proxy that fails `failure_threshold` requests in a
+    row, or its health check, is unhealthy: its profiles are moved to the others until it passes a check again.
+    Requests that do not belong to a profile, e.g. version lookups, use the least loaded proxy.
+    Without any proxy configured, requests go direct.
+    """
+
+    def __init__(self, proxies: list[Proxy], check_url: str, alpha: float = 0.3, failure_threshold: int = 3, imbalance: float = 2.0):
+        self.proxies = proxies
+        self.check_url = check_url
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.imbalance = imbalance
+        self._pins: dict[str, Proxy] = {}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def pinned(profile: str):
+        """send the requests of the block as `profile`."""
+        token = current_profile.set(profile)
+        try:
+            yield
+        finally:
+            current_profile.reset(token)
+
+    def _candidates(self) -> list[Proxy]:
+        healthy = [p for p in self.proxies if p.healthy]
+        # if every proxy is down, keep trying them rather than failing every request
+        return healthy if len(healthy) > 0 else self.proxies
+
+    def _pin(self, profile: str, proxy: Optional[Proxy]):
+        old = self._pins.pop(profile, None)
+        if old is not None:
+            old.pinned -= 1
+            proxy_pinned.set(old.pinned, proxy=old.name)
+        if proxy is not None:
+            self._pins[profile] = proxy
+            proxy.pinned += 1
+            proxy_pinned.set(proxy.pinned, proxy=proxy.name)
+
+    def unpin(self, profile: str):
+        """forget a removed profile, so it no longer counts towards the load of its proxy."""
+        self._pin(profile, None)
+
+    def retain(self, profiles: set[str]):
+        """unpin every profile not in `profiles`, e.g. deleted ones or logins that were abandoned."""
+        for profile in [p for p in self._pins if p not in profiles]:
+            self._pin(profile, None)
+
+    def select(self) -> Optional[Proxy]:
+        if len(self.proxies) == 0:
+            return None
+        profile = current_profile.get()
+        proxy = self._pins.get(profile) if profile is not None else None
+        if proxy is not None and (proxy.healthy or not any(p.healthy for p in self.proxies)):
+            return proxy
+        best = min(self._candidates(), key=lambda p: p.load)
+        if profile is not None:
+            if proxy is not None:
+                logger.info(f'Moved profile off unhealthy proxy. from = {proxy.name}, to = {best.name}')
+            self._pin(profile, best)
+        return best
+
+    def observe(self, proxy: Optional[Proxy], seconds: float, error: Optional[Exception] = None):
+        """record a request. only connection errors count as failures, an error response says nothing about the proxy."""
+        if proxy is None:
+            return
+        import requests
+        failed = isinstance(error, requests.ConnectionError)
+        proxy_requests.inc(proxy=proxy.name, result='error' if failed else 'success')
+        if failed:
+            proxy.failures += 1
+            if proxy.healthy and proxy.failures >= self.failure_threshold:
+                proxy.healthy = False
+                proxy_healthy.set(0, proxy=proxy.name)
+                logger.warning(f'Proxy is unhealthy. proxy = {proxy.name}, failures = {proxy.failures}')
+            return
+        proxy.failures = 0
+        proxy.latency += self.alpha * (seconds - proxy.latency)
+
+    def _check(self, proxy: Proxy, timeout: float) -> Optional[float]:
+        import requests
+        start = time.perf_counter()
+        try:
+            requests.head(self.check_url, proxies=proxy.proxies, timeout=timeout)
+        except requests.RequestException as e:
+            logger.warning(f'Proxy health check failed. proxy = {proxy.name}, error = {e}')
+            return None
+        return time.perf_counter() - start
+
+    async def check(self, timeout: float):
+        """probe every proxy, then rebalance the pins."""
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(None, functools.partial(self._check, p, timeout)) for p in self.proxies])
+        for proxy, seconds in zip(self.proxies, results):
+            if seconds is None:
+                proxy.healthy = False
+            else:
+                if not proxy.healthy:
+                    logger.info(f'Proxy recovered. proxy = {proxy.name}, seconds = {seconds:.3f}')
+                proxy.healthy = True
+                proxy.failures = 0
+                proxy.latency += self.alpha * (seconds - proxy.latency)
+            proxy_healthy.set(int(proxy.healthy), proxy=proxy.name)
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        unpin the profiles of unhealthy proxies, and move profiles off a proxy whose load is `imbalance` times
+        the lightest one's, one at a time, so accounts do not hop between IPs on every check.
+        """
+        for profile, proxy in list(self._pins.items()):
+            if not proxy.healthy:
+                self._pin(profile, None)
+        candidates = self._candidates()
+        if len(candidates) < 2:
+            return
+        for proxy in sorted(candidates, key=lambda p: p.load, reverse=True):
+            lightest = min(candidates, key=lambda p: p.load)
+            if proxy is lightest or proxy.pinned == 0 or proxy.load < self.imbalance * lightest.load:
+                continue
+            profile = next(k for k, v in self._pins.items() if v is proxy)
+            self._pin(profile, lightest)
+            logger.info(f'Rebalanced profile. from = {proxy.name}, to = {lightest.name}')
+
+
+def _configured_proxies() -> list[Proxy]:
+    if not config.get(config.NINTENDO_PROXY_ENABLED):
+        return []
+    urls: list[str] = config.get(config.NINTENDO_PROXY_URLS)
+    if len(urls) > 0:
+        return [Proxy(name=urllib.parse.urlsplit(url).netloc.rsplit('@', 1)[-1], proxies={'http': url, 'https': url}) for url in urls]
+    # the single proxy pair of older configs
+    proxies = {
+        'http': os.getenv('http_proxy', config.get(config.NINTENDO_PROXY_HTTP)),
+        'https': os.getenv('https_proxy', config.get(config.NINTENDO_PROXY_HTTPS)),
+    }
+    return [Proxy(name='default', proxies=proxies)]
+
+
+proxy_pool = ProxyPool(_configured_proxies(), check_url=config.get(config.NINTENDO_PROXY_CHECK_URL))
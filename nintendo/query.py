@@ -1,15 +1,21 @@
 import asyncio
 import functools
+import hashlib
 import json
 import re
-
-import requests
+import time
 
 import config
 import utils
 from locales import language_map
-from nintendo.login import APP_USER_AGENT, WEBVIEW_VERSION
-from nintendo.utils import ExpiredTokenError, proxies
+from nintendo.assets import AssetCache
+from nintendo.hedge import Hedger
+from nintendo.login import APP_USER_AGENT
+from nintendo.proxy import proxy_pool
+from nintendo.utils import ExpiredTokenError
+from nintendo.versions import registry
+from utils import metrics, deadline
+from utils.singleflight import SingleFlight
 
 accepted_languages = {
     'de-DE', 'en-GB', 'en-US', 'es-ES', 'es-MX', 'fr-CA', 'fr-FR', 'it-IT', 'ja-JP', 'ko-KR', 'nl-NL', 'ru-RU', 'zh-CN', 'zh-TW'
@@ -29,18 +35,39 @@ class QueryKey:
     XBattleHistoriesQuery = 'XBattleHistoriesQuery'
 
 
-graphql_query_map: dict[str, str] = config.get(config.NINTENDO_GRAPHQL_REQUEST_MAP)
+query_seconds = metrics.histogram('nintendo_query_seconds', 'Latency of SplatNet GraphQL queries.', ('query',))
+query_responses = metrics.counter('nintendo_query_responses_total', 'Responses of SplatNet GraphQL queries by status code.', ('query', 'status'))
+query_bytes = metrics.counter('nintendo_query_received_bytes_total', 'Bytes received by SplatNet GraphQL queries.', ('query',))
+image_seconds = metrics.histogram('nintendo_image_seconds', 'Latency of image downloads, including cache hits.')
+image_bytes = metrics.counter('nintendo_image_bytes_total', 'Bytes of downloaded images, including cache hits.')
+
+# detail pages never change once a battle is over, so a duplicate request is harmless
+HEDGED_QUERIES = {QueryKey.VsHistoryDetailQuery, QueryKey.CoopHistoryDetailQuery}
+hedger = Hedger(quantile=config.get(config.NINTENDO_HEDGE_QUANTILE), max_ratio=config.get(config.NINTENDO_HEDGE_MAX_RATIO))
+
+flights = SingleFlight('nintendo_query')
 
+asset_cache = AssetCache(
+    path=config.get(config.NINTENDO_ASSET_CACHE_PATH),
+    max_size=config.get(config.NINTENDO_ASSET_CACHE_MAX_SIZE) * 1024 * 1024,
+    ttl=config.get(config.NINTENDO_ASSET_CACHE_TTL),
+)
 
-@utils.retry_with_backoff()
+
+@utils.RetryPolicy()
 async def update_graphql_query_map() -> dict[str, str]:
     """Fetch GraphQL request ID from GitHub"""
-    global graphql_query_map
-    file = await asyncio.get_event_loop().run_in_executor(None, requests.get, "https://raw.githubusercontent.com/nintendoapis/splatnet3-types/main/src/graphql.ts")
+    import requests
+    url = "https://raw.githubusercontent.com/nintendoapis/splatnet3-types/main/src/graphql.ts"
+    fn = functools.partial(requests.get, url, headers=registry.conditional_headers('graphql'), timeout=config.get(config.NINTENDO_REQUEST_TIMEOUT))
+    file = await asyncio.get_event_loop().run_in_executor(None, fn)
+    if file.status_code == 304:
+        return registry.graphql_query_map
     raw = re.search(r'export enum RequestId {(?P<raw>(.|\n|\r)*?)}', file.text).group('raw')
     pairs = re.findall(r'\s*(\w+)\s*=\s*\'(\w+)\'\s*', raw)
-    graphql_query_map = {p[0]: p[1] for p in pairs}
-    return graphql_query_map
+    registry.graphql_query_map = {p[0]: p[1] for p in pairs}
+    registry.remember('graphql', file)
+    return registry.graphql_query_map
 
 
 def gen_graphql_body(sha256hash, varname=None, varvalue=None):
@@ -74,7 +101,7 @@ async def headbutt(bullet_token: str, language: str, country: str):
         'Authorization': f'Bearer {bullet_token}',  # update every time it's called with current global var
         'Accept-Language': language,
         'User-Agent': APP_USER_AGENT,
-        'X-Web-View-Ver': WEBVIEW_VERSION,
+        'X-Web-View-Ver': registry.webview_version,
         'Content-Type': 'application/json',
         'Accept': '*/*',
         'Origin': splatoon_url,
@@ -85,24 +112,64 @@ async def headbutt(bullet_token: str, language: str, country: str):
     return graphql_head
 
 
-@utils.retry_with_backoff(retries=3, skipped_exception=ExpiredTokenError)
 async def do_query(gtoken: str, bullet_token: str, language: str, country: str, query: str, varname=None, varvalue=None) -> str:
+    """identical queries of the same tokens in flight at the same time share one request, and its retries."""
+    token = hashlib.sha1(f'{gtoken}:{bullet_token}'.encode()).hexdigest()
+    key = (token, language, country, query, varname, varvalue)
+    return await flights.do(key, functools.partial(_do_query, gtoken, bullet_token, language, country, query, varname, varvalue))
+
+
+@utils.RetryPolicy(retries=3, fatal=(ExpiredTokenError,))
+async def _do_query(gtoken: str, bullet_token: str, language: str, country: str, query: str, varname=None, varvalue=None) -> str:
+    import requests
     url = 'https://api.lp1.av5ja.srv.nintendo.net/api/graphql'
-    sha = graphql_query_map[query]
+    sha = registry.graphql_query_map[query]
     headers = await headbutt(bullet_token, language, country)
     data = gen_graphql_body(sha, varname, varvalue)
 
-    fn = functools.partial(requests.post, url, data=data, headers=headers, cookies=dict(_gtoken=gtoken), proxies=proxies)
-    response: requests.Response = await asyncio.get_event_loop().run_in_executor(None, fn)
+    async def send() -> 'requests.Response':
+        timeout = deadline.timeout(config.get(config.NINTENDO_REQUEST_TIMEOUT))
+        proxy = proxy_pool.select()
+        fn = functools.partial(requests.post, url, data=data, headers=headers, cookies=dict(_gtoken=gtoken), proxies=proxy.proxies if proxy else {}, timeout=timeout)
+        start = time.perf_counter()
+        try:
+            r: requests.Response = await asyncio.get_event_loop().run_in_executor(None, fn)
+        except Exception as e:
+            proxy_pool.observe(proxy, time.perf_counter() - start, e)
+            query_responses.inc(query=query, status='error')
+            raise
+        finally:
+            query_seconds.observe(time.perf_counter() - start, query=query)
+        proxy_pool.observe(proxy, time.perf_counter() - start)
+        hedger.observe(query, time.perf_counter() - start)
+        query_responses.inc(query=query, status=r.status_code)
+        query_bytes.inc(len(r.content), query=query)
+        return r
+
+    if query in HEDGED_QUERIES and config.get(config.NINTENDO_HEDGE_ENABLED):
+        response = await hedger.run(query, send)
+    else:
+        response = await send()
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
     if response.status_code != 200:
         raise ExpiredTokenError(f'response status code is not 200. url = {response.url}, body = {response.text}')
     return response.text
 
 
-@utils.retry_with_backoff(retries=3, skipped_exception=ExpiredTokenError)
+@utils.RetryPolicy(retries=3, fatal=(ExpiredTokenError,))
 async def download_image(gtoken: str, bullet_token: str, language: str, country: str, url: str) -> bytes:
     headers = await headbutt(bullet_token, language, country)
-    fn = functools.partial(requests.get, url, headers=headers, cookies=dict(_gtoken=gtoken), proxies=proxies)
-    response: requests.Response = await asyncio.get_event_loop().run_in_executor(None, fn)
-    buf = bytearray(response.content)
+    timeout = deadline.timeout(config.get(config.NINTENDO_REQUEST_TIMEOUT))
+    proxy = proxy_pool.select()
+    fn = functools.partial(asset_cache.get, url, headers=headers, cookies=dict(_gtoken=gtoken), proxies=proxy.proxies if proxy else {}, timeout=timeout)
+    start = time.perf_counter()
+    try:
+        with image_seconds.time():
+            buf = await asyncio.get_event_loop().run_in_executor(None, fn)
+    except Exception as e:
+        proxy_pool.observe(proxy, time.perf_counter() - start, e)
+        raise
+    proxy_pool.observe(proxy, time.perf_counter() - start)
+    image_bytes.inc(len(buf))
     return buf
@@ -1,5 +1,4 @@
 import datetime
-import os
 import urllib.parse
 
 import config
@@ -8,14 +7,6 @@ link_prefix = 'npf71b963c1b7b6d119://auth#'
 link_prefix_len = len(link_prefix)
 update_interval = datetime.timedelta(hours=2).seconds
 
-if config.get(config.NINTENDO_PROXY_ENABLED):
-    proxies = {
-        'http': os.getenv('http_proxy', config.get(config.NINTENDO_PROXY_HTTP)),
-        'https': os.getenv('https_proxy', config.get(config.NINTENDO_PROXY_HTTPS)),
-    }
-else:
-    proxies = {}
-
 
 class NintendoError(Exception):
     pass
@@ -25,6 +16,15 @@ class ExpiredTokenError(NintendoError):
     pass
 
 
+class ProfileQuarantinedError(NintendoError):
+    pass
+
+
+# a 4xx reply to a login step, e.g. a revoked session token. sending the same request again gets the same answer
+class RequestRejectedError(NintendoError):
+    pass
+
+
 def is_valid_login_link(link: str) -> bool:
     if not link.startswith(link_prefix):
         return False
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import time
+from typing import Optional, TYPE_CHECKING
+
+import config
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger('nintendo.versions')
+
+
+class VersionRegistry:
+    """
+    App, s3s and webview versions and the GraphQL hash map, persisted to `path` so a restart starts from the last
+    known values instead of the config defaults. The validators (ETag/Last-Modified) of each source are kept too,
+    so a refresh can use conditional requests and skip parsing sources that did not change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.nsoapp_version: str = config.get(config.NINTENDO_APP_VERSION)
+        self.s3s_version: str = config.get(config.NINTENDO_S3S_VERSION)
+        self.webview_version: str = config.get(config.NINTENDO_WEBVIEW_VERSION)
+        self.graphql_query_map: dict[str, str] = dict(config.get(config.NINTENDO_GRAPHQL_REQUEST_MAP))
+        self.updated_at: float = 0
+        self.validators: dict[str, dict[str, Optional[str]]] = {}
+        self._mtime: Optional[int] = None
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        """whether the file was written by another process since it was last loaded or saved."""
+        return self._stat() != self._mtime
+
+    def load(self):
+        self._mtime = self._stat()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f'Failed to load version registry, using the config. path = {self.path}, error = {e}')
+            return
+        self.nsoapp_version = data.get('nsoapp_version', self.nsoapp_version)
+        self.s3s_version = data.get('s3s_version', self.s3s_version)
+        self.webview_version = data.get('webview_version', self.webview_version)
+        self.graphql_query_map = data.get('graphql_query_map', self.graphql_query_map)
+        self.updated_at = data.get('updated_at', 0)
+        self.validators = data.get('validators', {})
+        logger.info(f'Loaded version registry. path = {self.path}, updated_at = {self.updated_at}')
+
+    def save(self, refreshed: bool = True):
+        """write the registry. `refreshed` marks it fresh, only pass it when every source was checked."""
+        if refreshed:
+            self.updated_at = time.time()
+        data = {
+            'nsoapp_version': self.nsoapp_version,
+            's3s_version': self.s3s_version,
+            'webview_version': self.webview_version,
+            'graphql_query_map': self.graphql_query_map,
+            'updated_at': self.updated_at,
+            'validators': self.validators,
+        }
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.path)
+        self._mtime = self._stat()
+
+    def fresh(self, max_age: float) -> bool:
+        return time.time() - self.updated_at < max_age
+
+    def conditional_headers(self, source: str) -> dict[str, str]:
+        validator = self.validators.get(source, {})
+        headers = {}
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
+        return headers
+
+    def remember(self, source: str, response: 'requests.Response'):
+        """keep the validators of a source, after its new content was parsed successfully."""
+        self.validators[source] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+
+registry = VersionRegistry(config.get(config.NINTENDO_VERSIONS_PATH))
+registry.load()
@@ -1 +1 @@
-from utils.retry import retry_with_backoff
+from utils.retry import RetryPolicy
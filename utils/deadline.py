@@ -0,0 +1,104 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+from typing import Awaitable, Iterator, Optional, TypeVar, Union
+
+T = TypeVar('T')
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+class Extendable:
+    """
+    A deadline shared by work done on behalf of several callers, which later callers can move out to their own.
+    `at` is the monotonic time it passes, or None once a caller without a deadline joined.
+    """
+
+    def __init__(self, at: Optional[float]):
+        self.at = at
+
+    def extend(self):
+        """move the deadline out to the one of the current context, if that is later."""
+        at = _at()
+        if self.at is not None and (at is None or at > self.at):
+            self.at = at
+
+
+_deadline: contextvars.ContextVar[Union[float, Extendable, None]] = contextvars.ContextVar('deadline', default=None)
+
+
+def _at() -> Optional[float]:
+    deadline = _deadline.get()
+    return deadline.at if isinstance(deadline, Extendable) else deadline
+
+
+@contextlib.contextmanager
+def scope(seconds: float):
+    """
+    run the block under a deadline `seconds` from now. nested scopes can only shorten it.
+    the deadline is a context variable, so it follows awaited calls and tasks created inside the block.
+    """
+    deadline = time.monotonic() + seconds
+    current = _at()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def replace(seconds: Optional[float]):
+    """
+    run the block under a deadline `seconds` from now, or without any if None, whatever the surrounding deadline is.
+    for work that has to finish even when the caller gives up, e.g. storing refreshed tokens.
+    """
+    token = _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def extendable() -> Iterator[Extendable]:
+    """
+    run the block under the current deadline, as an `Extendable` that can be moved out while the block runs.
+    it only applies to what reads the deadline later, a nested `scope` keeps the deadline it started with.
+    """
+    shared = Extendable(_at())
+    token = _deadline.set(shared)
+    try:
+        yield shared
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """seconds left before the current deadline, or None without a deadline."""
+    deadline = _at()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+async def wait(aw: Awaitable[T]) -> T:
+    """await `aw` for as long as the current deadline allows, raising DeadlineExceededError when it passes."""
+    left = remaining()
+    if left is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, max(left, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError('deadline exceeded while waiting') from None
+
+
+def timeout(default: float) -> float:
+    """the timeout of a single attempt: `default`, capped by the remaining budget."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceededError('deadline exceeded before the request was sent')
+    return min(default, left)
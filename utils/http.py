@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+logger = logging.getLogger('utils.http')
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+# a slow or idle peer must not hold a connection slot, so every read is bounded
+HEADER_TIMEOUT = 10
+BODY_TIMEOUT = 30
+IDLE_TIMEOUT = 60
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+@dataclass
+class HTTPRequest:
+    method: str
+    path: str
+    headers: dict[str, str]
+    body: bytes
+
+
+@dataclass
+class HTTPResponse:
+    status: int = 200
+    body: bytes = b''
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+Handler = Callable[[HTTPRequest], Awaitable[HTTPResponse]]
+
+
+async def serve(host: str, port: int, handler: Handler, max_connections: int = 100) -> asyncio.AbstractServer:
+    """
+    Start a minimal HTTP/1.1 server with keep-alive. Header names are lower-cased.
+    Bodies must come with a Content-Length, chunked requests are answered with 411.
+    A connection is closed when its headers or body take too long to arrive, or when it stays idle between requests.
+    """
+    semaphore = asyncio.Semaphore(max_connections)
+
+    async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async with semaphore:
+            try:
+                while await _handle_request(reader, writer, handler):
+                    pass
+            except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                pass
+            except Exception as e:
+                logger.error(f'Failed to handle HTTP connection. error = {e}')
+            finally:
+                writer.close()
+
+    return await asyncio.start_server(on_connection, host, port, limit=MAX_HEADER_SIZE)
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handler: Handler) -> bool:
+    """handle one request, return whether the connection should be kept alive."""
+    # idle until the next request starts, then the rest of its head has to follow soon
+    first = await asyncio.wait_for(reader.readexactly(1), IDLE_TIMEOUT)
+    head = first + await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEADER_TIMEOUT)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split(' ', 2)
+    except ValueError:
+        await _write(writer, HTTPResponse(status=400), keep_alive=False)
+        return False
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    if 'transfer-encoding' in headers:
+        await _write(writer, HTTPResponse(status=411), keep_alive=False)
+        return False
+    length = headers.get('content-length', '0')
+    if not length.isdigit():
+        await _write(writer, HTTPResponse(status=400), keep_alive=False)
+        return False
+    length = int(length)
+    if length > MAX_BODY_SIZE:
+        await _write(writer, HTTPResponse(status=413), keep_alive=False)
+        return False
+    body = await asyncio.wait_for(reader.readexactly(length), BODY_TIMEOUT) if length > 0 else b''
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+    try:
+        response = await handler(HTTPRequest(method=method, path=path, headers=headers, body=body))
+    except Exception as e:
+        logger.error(f'Failed to handle HTTP request. path = {path}, error = {e}')
+        response = HTTPResponse(status=500)
+    await _write(writer, response, keep_alive)
+    return keep_alive
+
+
+async def _write(writer: asyncio.StreamWriter, response: HTTPResponse, keep_alive: bool):
+    headers = {
+        'Content-Length': str(len(response.body)),
+        'Connection': 'keep-alive' if keep_alive else 'close',
+        **response.headers,
+    }
+    head = f'HTTP/1.1 {response.status} {REASONS.get(response.status, "")}\r\n'
+    head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    writer.write(head.encode('latin-1') + b'\r\n' + response.body)
+    await writer.drain()
@@ -0,0 +1,326 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+import config
+from utils import metrics
+
+logger = logging.getLogger('utils.lease')
+
+lease_acquisitions = metrics.counter('lease_acquisitions_total', 'Lease acquisition attempts by result.', ('name', 'result'))
+lease_leader = metrics.gauge('lease_leader', 'Whether this process holds the lease.', ('name',))
+
+_current: contextvars.ContextVar[Optional['Lease']] = contextvars.ContextVar('lease', default=None)
+
+
+class LeaseLostError(RuntimeError):
+    pass
+
+
+@dataclass
+class Lease:
+    name: str
+    holder: str
+    # the fencing token: increases every time the lease changes hands, so a stale holder can be told apart
+    token: int
+    expires_at: float
+
+
+class LeaseStore:
+    """
+    A named lease held by one holder at a time. `acquire` takes a free or expired lease with a new fencing token,
+    renews the lease of the same holder with the same token, or returns None while another holder has it.
+    Blocking, so call it in an executor.
+    """
+
+    def acquire(self, name: str, holder: str, ttl: float) -> Optional[Lease]:
+        raise NotImplementedError
+
+    def release(self, name: str, holder: str):
+        raise NotImplementedError
+
+    def current(self, name: str) -> Optional[Lease]:
+        raise NotImplementedError
+
+
+class MemoryLeaseStore(LeaseStore):
+    """leases of a single process, with a replaceable clock. for tests, or to run without any shared store."""
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._leases: dict[str, Lease] = {}
+        self._tokens: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, holder: str, ttl: float) -> Optional[Lease]:
+        with self._lock:
+            now = self.clock()
+            lease = self._leases.get(name)
+            if lease is not None and lease.expires_at > now:
+                if lease.holder != holder:
+                    return None
+                lease.expires_at = now + ttl
+                return Lease(**vars(lease))
+            self._tokens[name] = self._tokens.get(name, 0) + 1
+            self._leases[name] = Lease(name, holder, self._tokens[name], now + ttl)
+            return Lease(**vars(self._leases[name]))
+
+    def release(self, name: str, holder: str):
+        with self._lock:
+            lease = self._leases.get(name)
+            if lease is not None and lease.holder == holder:
+                del self._leases[name]
+
+    def current(self, name: str) -> Optional[Lease]:
+        with self._lock:
+            lease = self._leases.get(name)
+            if lease is None or lease.expires_at <= self.clock():
+                return None
+            return Lease(**vars(lease))
+
+
+class SqliteLeaseStore(LeaseStore):
+    """leases shared by the processes of one host, in a sqlite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT, token INTEGER NOT NULL, expires_at REAL NOT NULL)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            # take the write lock up front, so the read and the write of `acquire` are atomic
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def acquire(self, name: str, holder: str, ttl: float) -> Optional[Lease]:
+        with self._transaction() as db:
+            now = time.time()
+            row = db.execute('SELECT holder, token, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[2] > now:
+                if row[0] != holder:
+                    return None
+                db.execute('UPDATE leases SET expires_at = ? WHERE name = ?', (now + ttl, name))
+                return Lease(name, holder, row[1], now + ttl)
+            token = (row[1] if row is not None else 0) + 1
+            db.execute('INSERT OR REPLACE INTO leases (name, holder, token, expires_at) VALUES (?, ?, ?, ?)', (name, holder, token, now + ttl))
+            return Lease(name, holder, token, now + ttl)
+
+    def release(self, name: str, holder: str):
+        # expire instead of delete, the row keeps the last token so tokens never go back
+        with self._transaction() as db:
+            db.execute('UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?', (name, holder))
+
+    def current(self, name: str) -> Optional[Lease]:
+        with self._transaction() as db:
+            row = db.execute('SELECT holder, token, expires_at FROM leases WHERE name = ? AND expires_at > ?', (name, time.time())).fetchone()
+        return Lease(name, *row) if row is not None else None
+
+
+class RedisLeaseStore(LeaseStore):
+    """
+    leases shared across hosts, in Redis or anything speaking its protocol and Lua scripting.
+    `client` is a redis-py compatible client; the token counter has no expiry, so tokens never go back.
+    """
+
+    ACQUIRE = '''
+        local holder = redis.call('HGET', KEYS[1], 'holder')
+        if holder == ARGV[1] then
+            redis.call('PEXPIRE', KEYS[1], ARGV[2])
+            return tonumber(redis.call('HGET', KEYS[1], 'token'))
+        end
+        if holder then
+            return false
+        end
+        local token = redis.call('INCR', KEYS[2])
+        redis.call('HSET', KEYS[1], 'holder', ARGV[1], 'token', token)
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        return token
+    '''
+    RELEASE = '''
+        if redis.call('HGET', KEYS[1], 'holder') == ARGV[1] then
+            redis.call('DEL', KEYS[1])
+        end
+    '''
+
+    def __init__(self, client, prefix: str = 'lease:'):
+        self.client = client
+        self.prefix = prefix
+
+    def acquire(self, name: str, holder: str, ttl: float) -> Optional[Lease]:
+        key = f'{self.prefix}{name}'
+        token = self.client.eval(self.ACQUIRE, 2, key, f'{key}:token', holder, int(ttl * 1000))
+        if token is None:
+            return None
+        return Lease(name, holder, int(token), time.time() + ttl)
+
+    def release(self, name: str, holder: str):
+        self.client.eval(self.RELEASE, 1, f'{self.prefix}{name}', holder)
+
+    def current(self, name: str) -> Optional[Lease]:
+        key = f'{self.prefix}{name}'
+        holder, token = self.client.hmget(key, 'holder', 'token')
+        ttl = self.client.pttl(key)
+        if holder is None or ttl < 0:
+            return None
+        holder = holder.decode() if isinstance(holder, bytes) else holder
+        return Lease(name, holder, int(token), time.time() + ttl / 1000)
+
+
+class LeaseManager:
+    """
+    Runs global jobs on exactly one replica. The first replica to run a job takes its lease and keeps it,
+    renewing every third of `ttl`; the others skip the job while the lease is held. A replica that stops releases
+    its leases, and a crashed one loses them after `ttl`, so another replica takes over on its next run.
+    A replica that finds it lost a lease, e.g. after a stall longer than `ttl`, calls the job's `on_lost` hook to
+    stop the work the lease guarded, since another replica may be doing it by then.
+    Side effects that must not happen twice check the fencing token with `check` first.
+    """
+
+    def __init__(self, store: LeaseStore, holder: str, ttl: float):
+        self.store = store
+        self.holder = holder
+        self.ttl = ttl
+        self.held: dict[str, Lease] = {}
+        self._on_lost: dict[str, Callable[[], Awaitable]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def acquire(self, name: str) -> Optional[Lease]:
+        lease = await self._run(self.store.acquire, name, self.holder, self.ttl)
+        previous = self.held.pop(name, None)
+        if lease is None:
+            lease_acquisitions.inc(name=name, result='busy')
+            lease_leader.set(0, name=name)
+            if previous is not None:
+                await self._lost(name, previous)
+            return None
+        if previous is None or previous.token != lease.token:
+            if previous is not None:
+                # expired and taken again, maybe after another replica had it in between
+                await self._lost(name, previous)
+            lease_acquisitions.inc(name=name, result='acquired')
+            logger.info(f'Acquired lease. name = {name}, holder = {self.holder}, token = {lease.token}')
+        else:
+            lease_acquisitions.inc(name=name, result='renewed')
+        lease_leader.set(1, name=name)
+        self.held[name] = lease
+        return lease
+
+    async def _lost(self, name: str, lease: Lease):
+        logger.warning(f'Lost lease. name = {name}, token = {lease.token}')
+        lease_leader.set(0, name=name)
+        on_lost = self._on_lost.pop(name, None)
+        if on_lost is None:
+            return
+        try:
+            await on_lost()
+        except Exception as e:
+            logger.error(f'Failed to stop the work of a lost lease. name = {name}, error = {e}')
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._renew())
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            for name in list(self.held):
+                try:
+                    await self.acquire(name)
+                except Exception as e:
+                    logger.error(f'Failed to renew lease. name = {name}, error = {e}')
+                    # keep the lease locally while it may still be valid, give it up once it expired
+                    lease = self.held.get(name)
+                    if lease is not None and lease.expires_at <= time.time():
+                        del self.held[name]
+                        await self._lost(name, lease)
+
+    async def release_all(self):
+        if self._task is not None:
+            self._task.cancel()
+        for name in list(self.held):
+            self.held.pop(name)
+            self._on_lost.pop(name, None)
+            lease_leader.set(0, name=name)
+            try:
+                await self._run(self.store.release, name, self.holder)
+            except Exception as e:
+                logger.error(f'Failed to release lease. name = {name}, error = {e}')
+
+    async def check(self):
+        """
+        raise LeaseLostError unless the lease of the running singleton job is still ours.
+        this reads the store and then lets the caller act, so it narrows the window for a stale leader but does not
+        close it: the resource itself does not check the fencing token, and the lease can be lost right after.
+        """
+        lease = _current.get()
+        if lease is None:
+            return
+        current = await self._run(self.store.current, lease.name)
+        if current is None or current.holder != self.holder or current.token != lease.token:
+            raise LeaseLostError(f'Lease lost. name = {lease.name}, token = {lease.token}')
+
+    def singleton(self, follower: Optional[Callable[..., Awaitable]] = None, on_lost: Optional[Callable[..., Awaitable]] = None):
+        """
+        decorator for job callbacks, running them only on the replica holding the lease named after the job.
+        the others call `follower` instead, e.g. to pick up what the leader did.
+        if the lease is lost later, `on_lost` is called with the context of the last run that held it.
+        """
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(context):
+                lease = await self.acquire(fn.__name__)
+                if lease is None:
+                    if follower is not None:
+                        await follower(context)
+                    return
+                if on_lost is not None:
+                    self._on_lost[fn.__name__] = functools.partial(on_lost, context)
+                token = _current.set(lease)
+                try:
+                    return await fn(context)
+                finally:
+                    _current.reset(token)
+
+            return wrapper
+
+        return decorator
+
+
+def create_store(backend: str) -> LeaseStore:
+    if backend == 'memory':
+        return MemoryLeaseStore()
+    if backend == 'redis':
+        import redis
+
+        return RedisLeaseStore(redis.Redis.from_url(config.get(config.LEASE_REDIS_URL)))
+    return SqliteLeaseStore(config.get(config.LEASE_PATH))
+
+
+leases = LeaseManager(
+    store=create_store(config.get(config.LEASE_BACKEND)),
+    holder=config.get(config.CLUSTER_WORKER_ID) or socket.gethostname(),
+    ttl=config.get(config.LEASE_TTL),
+)
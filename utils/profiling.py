@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def _frame_name(frame) -> str:
+    return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}'
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _sample(thread_id: int, duration: float, interval: float) -> collections.Counter:
+    stacks = collections.Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_collapse(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+async def _sample_with_timer(duration: float, interval: float) -> collections.Counter:
+    stacks = collections.Counter()
+
+    def on_signal(signum, frame):
+        if frame is not None:
+            stacks[_collapse(frame)] += 1
+
+    previous = signal.signal(signal.SIGPROF, on_signal)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+    return stacks
+
+
+async def sample_cpu(duration: float, interval: float = 0.005) -> collections.Counter:
+    """
+    sample the stack of the thread running the event loop every `interval` seconds of CPU time.
+    returns the collapsed stacks (`root;...;leaf`) with their sample counts.
+
+    a profiling timer signal is used when the loop runs in the main thread. otherwise a worker thread polls
+    the loop thread's frame, which over-samples blocking calls that release the GIL, like `select`.
+    """
+    if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+        return await _sample_with_timer(duration, interval)
+    thread_id = threading.get_ident()
+    return await asyncio.get_running_loop().run_in_executor(None, _sample, thread_id, duration, interval)
+
+
+def collapsed(stacks: collections.Counter) -> str:
+    """the stacks in the collapsed format read by flamegraph.pl and speedscope."""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def cpu_report(stacks: collections.Counter, top: int = 15) -> str:
+    total = sum(stacks.values())
+    if total == 0:
+        return 'no samples'
+    own = collections.Counter()
+    cumulative = collections.Counter()
+    for stack, count in stacks.items():
+        names = stack.split(';')
+        own[names[-1]] += count
+        for name in set(names):
+            cumulative[name] += count
+    lines = [f'samples: {total}', '', 'self:']
+    lines += [f'{count / total:6.1%} {name}' for name, count in own.most_common(top)]
+    lines += ['', 'cumulative:']
+    lines += [f'{count / total:6.1%} {name}' for name, count in cumulative.most_common(top)]
+    return '\n'.join(lines)
+
+
+async def snapshot_memory(duration: float, frames: int = 16) -> tuple[tracemalloc.Snapshot, tracemalloc.Snapshot]:
+    """take two tracemalloc snapshots `duration` seconds apart. tracing is stopped afterwards unless it was already on."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(duration)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    return before.filter_traces(filters), after.filter_traces(filters)
+
+
+def _size(size: int) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GiB'
+
+
+def memory_report(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, top: int = 10) -> str:
+    stats = after.statistics('lineno')
+    lines = [f'traced: {_size(sum(s.size for s in stats))}', '', 'top allocators:']
+    lines += [f'{_size(s.size):>8} {s.count:>7} {_location(s.traceback[0])}' for s in stats[:top]]
+    lines += ['', 'growth:']
+    lines += [f'{_size(s.size_diff):>8} {s.count_diff:>+7} {_location(s.traceback[0])}' for s in after.compare_to(before, 'lineno')[:top] if s.size_diff != 0]
+    return '\n'.join(lines)
+
+
+def memory_collapsed(snapshot: tracemalloc.Snapshot) -> str:
+    """allocated bytes by collapsed traceback, for memory flame graphs."""
+    lines = []
+    for s in snapshot.statistics('traceback'):
+        stack = ';'.join(_location(frame) for frame in s.traceback)
+        lines.append(f'{stack} {s.size}\n')
+    return ''.join(lines)
+
+
+def _location(frame: tracemalloc.Frame) -> str:
+    return f'{os.path.basename(frame.filename)}:{frame.lineno}'
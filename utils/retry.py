@@ -1,31 +1,151 @@
 import asyncio
+import email.utils
+import enum
 import functools
 import logging
 import random
+import time
+from typing import Callable, Optional
 
-from telegram.error import RetryAfter
+from utils import metrics, deadline as deadlines
 
+logger = logging.getLogger('utils.retry')
+
+retries_total = metrics.counter('retries_total', 'Retries of functions wrapped by a retry policy.', ('function', 'kind'))
+retries_given_up = metrics.counter('retries_given_up_total', 'Failures that were not retried, by reason.', ('function', 'reason'))
+
+# the retry budget shared by every policy: on average 2 retries per second, in bursts of up to 30.
+BUDGET_PER_SECOND = 2
+BUDGET_BURST = 30
+
+
+class ErrorKind(enum.Enum):
+    Retryable = 'retryable'
+    RateLimited = 'rate_limited'
+    Fatal = 'fatal'
+
+
+class RetryBudget:
+    """a token bucket capping retries across all policies, so retries stop amplifying load during incidents."""
+
+    def __init__(self, per_second: float, burst: float):
+        self.per_second = per_second
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def acquire(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+budget = RetryBudget(BUDGET_PER_SECOND, BUDGET_BURST)
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """seconds to wait as told by the server, from telegram's RetryAfter or a 429/503 Retry-After header."""
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is not None:
+        return float(getattr(retry_after, 'total_seconds', lambda: retry_after)())
+    import requests
+    response = getattr(e, 'response', None)
+    if isinstance(response, requests.Response) and response.status_code in (429, 503):
+        header = response.headers.get('Retry-After')
+        if header is None:
+            return None
+        if header.isdigit():
+            return float(header)
+        try:
+            return max(email.utils.parsedate_to_datetime(header).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def classify(e: Exception) -> tuple[ErrorKind, Optional[float]]:
+    """
+    the default classification. rate limits come with the delay to wait. parse errors and 4xx responses are fatal,
+    since sending the same request again gives the same answer. anything else, e.g. a network error, is retryable.
+    """
+    if isinstance(e, deadlines.DeadlineExceededError):
+        return ErrorKind.Fatal, None
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        return ErrorKind.RateLimited, retry_after
+    if isinstance(e, (ValueError, TypeError, KeyError, AttributeError)):
+        return ErrorKind.Fatal, None
+    import requests
+    if isinstance(e, requests.HTTPError) and e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code not in (408, 429):
+        return ErrorKind.Fatal, None
+    return ErrorKind.Retryable, None
+
+
+class RetryPolicy:
+    """
+    Decorator retrying a coroutine function with full-jitter exponential backoff.
+
+    - `fatal` exceptions are raised at once, on top of what `classifier` considers fatal.
+    - rate limited errors wait for the server's Retry-After instead of the backoff.
+    - retries stop when the shared retry budget runs dry, or when the next attempt would start after `deadline` seconds
+      or after the deadline of the surrounding `utils.deadline.scope`.
+    """
+
+    def __init__(
+            self,
+            retries: int = 5,
+            backoff_in_seconds: float = 1,
+            max_second: float = 10,
+            deadline: Optional[float] = None,
+            fatal: tuple[type[Exception], ...] = (),
+            classifier: Callable[[Exception], tuple[ErrorKind, Optional[float]]] = classify,
+            retry_budget: RetryBudget = budget,
+    ):
+        self.retries = retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.max_second = max_second
+        self.deadline = deadline
+        self.fatal = fatal
+        self.classifier = classifier
+        self.retry_budget = retry_budget
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_second, self.backoff_in_seconds * 2 ** attempt))
+
+    def __call__(self, fn):
+        name = fn.__qualname__
 
-def retry_with_backoff(retries=5, backoff_in_seconds=1, max_second=10, skipped_exception=None):
-    def rwb(fn):
         @functools.wraps(fn)
         async def wrapper(*args, **kwargs):
-            x = 0
+            start = time.monotonic()
+            attempt = 0
             while True:
                 try:
                     return await fn(*args, **kwargs)
                 except Exception as e:
-                    if skipped_exception is not None and isinstance(e, skipped_exception):
+                    kind, retry_after = (ErrorKind.Fatal, None) if isinstance(e, self.fatal) else self.classifier(e)
+                    if kind == ErrorKind.Fatal:
+                        retries_given_up.inc(function=name, reason='fatal')
                         raise
-                    if x == retries:
+                    if attempt >= self.retries:
+                        retries_given_up.inc(function=name, reason='exhausted')
                         raise
-
-                    else:
-                        sleep = (backoff_in_seconds * 2 ** x + random.uniform(0, 1))
-                        sleep = min(max_second, sleep)
+                    sleep = retry_after if kind == ErrorKind.RateLimited else self.delay(attempt)
+                    left = deadlines.remaining()
+                    if (self.deadline is not None and time.monotonic() - start + sleep > self.deadline) or (left is not None and sleep >= left):
+                        retries_given_up.inc(function=name, reason='deadline')
+                        raise
+                    # the server asked for the delay, so waiting for it does not add load
+                    if kind == ErrorKind.Retryable and not self.retry_budget.acquire():
+                        retries_given_up.inc(function=name, reason='budget')
+                        logger.warning(f'Retry budget exhausted. function = {name}, error = {e}')
+                        raise
+                    retries_total.inc(function=name, kind=kind.value)
                     await asyncio.sleep(sleep)
-                    x += 1
+                    attempt += 1
 
         return wrapper
-
-    return rwb
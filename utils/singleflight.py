@@ -0,0 +1,44 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from utils import metrics, deadline
+
+calls_total = metrics.counter('singleflight_calls_total', 'Calls through a single-flight group, by whether they ran or joined a call in flight.', ('group', 'result'))
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first call runs, the ones arriving while it is in flight wait
+    for it and share its result or exception. Nothing is cached, a call arriving after it finished runs again.
+    The call runs under the latest deadline among its callers: the one of the caller that started it, moved out
+    whenever a caller with a later one joins, so its requests and retries stop once no caller can use the result.
+    Each caller waits for it as long as its own deadline allows.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, tuple[asyncio.Future, deadline.Extendable]] = {}
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if key in self._calls and self._calls[key][0] is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # retrieve the exception, in case every caller was cancelled and nobody else will
+            future.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            calls_total.inc(group=self.name, result='leader')
+            with deadline.extendable() as shared:
+                future = asyncio.ensure_future(fn())
+            self._calls[key] = (future, shared)
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            calls_total.inc(group=self.name, result='coalesced')
+            future, shared = call
+            shared.extend()
+        # a cancelled caller must not cancel the call the others are waiting for
+        return await deadline.wait(asyncio.shield(future))
@@ -0,0 +1,56 @@
+import builtins
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger('utils.startup')
+
+started_at = time.perf_counter()
+
+
+class ImportProfiler:
+    """Measures the time spent importing each module by wrapping `builtins.__import__`."""
+
+    def __init__(self):
+        self.enabled = False
+        self.self_times: dict[str, float] = {}
+        self.total_times: dict[str, float] = {}
+        self._stack: list[float] = []
+        self._original = builtins.__import__
+        self._thread = None
+
+    def install(self):
+        self.enabled = True
+        self._thread = threading.get_ident()
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules or threading.get_ident() != self._thread:
+            return self._original(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self._stack.pop()
+            if len(self._stack) > 0:
+                self._stack[-1] += elapsed
+            self.self_times[name] = self.self_times.get(name, 0.0) + elapsed - children
+            self.total_times[name] = self.total_times.get(name, 0.0) + elapsed
+
+    def report(self, top: int = 20):
+        logger.info(f'Imported modules. number = {len(self.total_times)}, elapsed = {time.perf_counter() - started_at:.3f}s')
+        for name, t in sorted(self.self_times.items(), key=lambda x: x[1], reverse=True)[:top]:
+            logger.info(f'Import time. module = {name}, self = {t * 1000:.1f}ms, cumulative = {self.total_times[name] * 1000:.1f}ms')
+
+
+profiler = ImportProfiler()
+
+
+def report_first_update():
+    logger.info(f'Time to first update. elapsed = {time.perf_counter() - started_at:.3f}s')
@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import secrets
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import config
+
+logger = logging.getLogger('utils.tracing')
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': k, 'value': {'stringValue': str(v)}} for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error is not None else {'code': 1},
+        }
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """
+    Keeps finished spans in a ring buffer. The trace id lives in a context variable,
+    so spans opened in nested calls and in tasks created under a span join the same trace.
+    If `export_path` is set, each finished trace is appended to it as one OTLP/JSON line.
+    """
+
+    def __init__(self, capacity: int, export_path: str = None):
+        self.spans: collections.deque[Span] = collections.deque(maxlen=capacity)
+        self.export_path = export_path
+        self._pending: dict[str, list[Span]] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent = current_span.get()
+        span = Span(
+            trace_id=parent.trace_id if parent is not None else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id if parent is not None else None,
+            name=name,
+            start_ns=time.time_ns(),
+            attributes=attributes,
+        )
+        if parent is None and self.export_path:
+            self._pending[span.trace_id] = []
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span)
+
+    def traced(self, fn):
+        """decorator opening a span named after the wrapped coroutine function."""
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with self.span(fn.__name__):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    def _finish(self, span: Span):
+        self.spans.append(span)
+        if not self.export_path:
+            return
+        if span.parent_id is None:
+            self._export(self._pending.pop(span.trace_id, []) + [span])
+        elif span.trace_id in self._pending:
+            self._pending[span.trace_id].append(span)
+        else:
+            # the root is done already, e.g. a message flushed after the tick finished
+            self._export([span])
+
+    def _export(self, spans: list[Span]):
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'splatoon3-bot'}}]},
+                'scopeSpans': [{'scope': {'name': 'bot'}, 'spans': [s.to_otlp() for s in spans]}],
+            }]
+        }
+        try:
+            with open(self.export_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(request, separators=(',', ':')) + '\n')
+        except OSError as e:
+            logger.error(f'Failed to export spans. path = {self.export_path}, error = {e}')
+
+    def trace(self, trace_id: str) -> list[Span]:
+        return [s for s in self.spans if s.trace_id == trace_id]
+
+    def slowest(self, n: int, name: str = None, within: float = 3600) -> list[tuple[Span, list[Span]]]:
+        """the slowest `n` root spans finished in the last `within` seconds, each with the other spans of its trace."""
+        since = time.time_ns() - int(within * 1e9)
+        roots = [s for s in self.spans if s.parent_id is None and s.end_ns >= since and (name is None or s.name == name)]
+        roots = sorted(roots, key=lambda s: s.duration, reverse=True)[:n]
+        return [(root, [s for s in self.trace(root.trace_id) if s is not root]) for root in roots]
+
+
+tracer = Tracer(capacity=config.get(config.TRACING_CAPACITY), export_path=config.get(config.TRACING_EXPORT_PATH) or None)
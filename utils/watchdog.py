@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Optional
+
+import config
+from utils import metrics
+
+logger = logging.getLogger('utils.watchdog')
+
+loop_lag_seconds = metrics.histogram('loop_lag_seconds', 'Event loop lag measured by the watchdog heartbeat.', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+loop_stalls = metrics.counter('loop_stalls_total', 'Times the event loop was blocked longer than the watchdog threshold.')
+
+STACK_DEPTH = 8
+
+
+@dataclass
+class Offender:
+    location: str
+    stack: str
+    count: int = 0
+    total: float = 0
+    worst: float = 0
+
+
+class Watchdog:
+    """
+    A heartbeat task measures event loop lag. When the heartbeat is late by more than `threshold` seconds,
+    a watcher thread captures the stack of the loop thread, i.e. whatever is blocking it, and attributes the stall to it.
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = 0.0
+        self._beat = time.monotonic()
+        self._thread_id: Optional[int] = None
+        self._offenders: dict[str, Offender] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """start watching the running loop."""
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='watchdog', daemon=True).start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.lag = max(self._beat - start - self.interval, 0)
+            loop_lag_seconds.observe(self.lag)
+
+    def _watch(self):
+        offender: Optional[Offender] = None
+        worst = 0
+        while self._task is not None:
+            time.sleep(self.interval / 2)
+            behind = time.monotonic() - self._beat - self.interval
+            if behind > self.threshold:
+                if offender is None:
+                    offender = self._capture(behind)
+                worst = max(worst, behind)
+            elif offender is not None:
+                with self._lock:
+                    offender.count += 1
+                    offender.total += worst
+                    offender.worst = max(offender.worst, worst)
+                loop_stalls.inc()
+                logger.warning(f'Event loop was blocked. duration = {worst:.3f}s, location = {offender.location}')
+                offender, worst = None, 0
+
+    def _capture(self, behind: float) -> Offender:
+        frame = sys._current_frames().get(self._thread_id)
+        summary = traceback.extract_stack(frame)[-STACK_DEPTH:] if frame is not None else []
+        del frame
+        location = _location(summary)
+        stack = ''.join(traceback.format_list(summary))
+        with self._lock:
+            offender = self._offenders.setdefault(location, Offender(location=location, stack=stack))
+        logger.warning(f'Event loop is blocked. lag = {behind:.3f}s, stack = \n{stack}')
+        return offender
+
+    def top(self, n: int) -> list[Offender]:
+        """offenders ordered by the total time they blocked the loop."""
+        with self._lock:
+            return sorted(self._offenders.values(), key=lambda o: o.total, reverse=True)[:n]
+
+
+def _location(summary: traceback.StackSummary) -> str:
+    """the innermost frame of our own code, falling back to the innermost frame."""
+    if len(summary) == 0:
+        return 'unknown'
+    root = os.getcwd()
+    own = [f for f in summary if f.filename.startswith(root) and 'site-packages' not in f.filename]
+    frame = own[-1] if len(own) > 0 else summary[-1]
+    return f'{os.path.relpath(frame.filename, root) if frame.filename.startswith(root) else os.path.basename(frame.filename)}:{frame.lineno} {frame.name}'
+
+
+watchdog = Watchdog(threshold=config.get(config.WATCHDOG_THRESHOLD), interval=config.get(config.WATCHDOG_INTERVAL))